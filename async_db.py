@@ -0,0 +1,108 @@
+'''Awaitable versions of the db_utils functions.
+
+With the "async" backend (default) every call runs on a dedicated thread
+pool, each worker thread holding its own pooled sqlite3 connection, so a
+slow query never blocks the event loop. The "sync" backend runs the call
+inline on the loop, which is only useful for debugging and comparisons.
+Pick one with TRIPPY_DB_BACKEND or `set_backend`.
+'''
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import db_utils
+
+BACKENDS = ("async", "sync")
+ReturnT = TypeVar("ReturnT")
+
+_backend = os.environ.get("TRIPPY_DB_BACKEND", "async")
+_max_workers = int(os.environ.get("TRIPPY_DB_THREADS", 8))
+_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def set_backend(backend: str) -> None:
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown db backend {backend!r}")
+    _backend = backend
+
+
+def get_backend() -> str:
+    return _backend
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                _max_workers, thread_name_prefix="db")
+        return _executor
+
+
+def shutdown() -> None:
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def awaitable(fn: Callable[..., ReturnT]) -> Callable[..., Awaitable[ReturnT]]:
+    '''wrap a blocking db_utils function into a coroutine function'''
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs) -> ReturnT:
+        if _backend == "sync":
+            return fn(*args, **kwargs)
+        # carry context variables (request scoped state) into the worker
+        call = functools.partial(
+            contextvars.copy_context().run, fn, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(
+            _get_executor(), call)
+    return wrapper
+
+
+db_get_info = awaitable(db_utils.db_get_info)
+db_get_flight_by_id = awaitable(db_utils.db_get_flight_by_id)
+db_get_hotel_by_id = awaitable(db_utils.db_get_hotel_by_id)
+db_get_guide_by_id = awaitable(db_utils.db_get_guide_by_id)
+db_get_car_rental_by_id = awaitable(db_utils.db_get_car_rental_by_id)
+db_get_popular_packages = awaitable(db_utils.db_get_popular_packages)
+db_get_popular_packages_page = awaitable(db_utils.db_get_popular_packages_page)
+db_get_trending_packages = awaitable(db_utils.db_get_trending_packages)
+db_get_package_by_id = awaitable(db_utils.db_get_package_by_id)
+db_get_packages_by_ids = awaitable(db_utils.db_get_packages_by_ids)
+db_get_packages_by_country = awaitable(db_utils.db_get_packages_by_country)
+db_get_packages_by_destination = awaitable(db_utils.db_get_packages_by_destination)
+db_search_packages = awaitable(db_utils.db_search_packages)
+db_query_packages = awaitable(db_utils.db_query_packages)
+db_get_hotels_by_destination = awaitable(db_utils.db_get_hotels_by_destination)
+db_get_restaurants_by_destination = awaitable(db_utils.db_get_restaurants_by_destination)
+get_available_guide = awaitable(db_utils.get_available_guide)
+get_available_hotel = awaitable(db_utils.get_available_hotel)
+get_nearest_restaurant = awaitable(db_utils.get_nearest_restaurant)
+get_nearest_restaurants = awaitable(db_utils.get_nearest_restaurants)
+create_user = awaitable(db_utils.create_user)
+insert_user = awaitable(db_utils.insert_user)
+update_user_password_key = awaitable(db_utils.update_user_password_key)
+get_user_by_name = awaitable(db_utils.get_user_by_name)
+user_exists = awaitable(db_utils.user_exists)
+validate_user_password = awaitable(db_utils.validate_user_password)
+create_order = awaitable(db_utils.create_order)
+create_orders = awaitable(db_utils.create_orders)
+get_packages_by_username = awaitable(db_utils.get_packages_by_username)
+get_itinerary = awaitable(db_utils.get_itinerary)
+delete_order = awaitable(db_utils.delete_order)
+get_available_flight = awaitable(db_utils.get_available_flight)
+get_user = awaitable(db_utils.get_user)
+get_package_id_by_destination = awaitable(db_utils.get_package_id_by_destination)
+get_user_order = awaitable(db_utils.get_user_order)
+modify_user_order = awaitable(db_utils.modify_user_order)
+change_user_guide = awaitable(db_utils.change_user_guide)
+change_user_hotel = awaitable(db_utils.change_user_hotel)
+change_user_flight = awaitable(db_utils.change_user_flight)
@@ -0,0 +1,89 @@
+'''Benchmark suite entry point, run from the repository root.
+
+    python -m benchmarks --scale small --suite micro,load --out results.json
+    python -m benchmarks --baseline benchmarks/baseline.json --tolerance 0.25
+    python -m benchmarks --suite load --mix browse --replay capture.jsonl
+
+Results are printed as JSON. With --baseline the run exits with status 1
+when any benchmark is slower than the baseline by more than --tolerance.
+'''
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+from benchmarks.stats import compare, load_json
+from benchmarks.synth_db import SCALES, generate_db
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    for table in SCALES["small"]:
+        parser.add_argument(f"--{table.replace('_', '-')}", type=int,
+                            help=f"override the number of {table}")
+    parser.add_argument("--db", help="benchmark this database instead of a synthetic one")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--suite", default="micro,load",
+                        help="comma separated: micro, load")
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="calls per micro-benchmark")
+    parser.add_argument("--mix", default="browse,login,orders",
+                        help="comma separated load mixes: browse, login, orders")
+    parser.add_argument("--requests", type=int, default=500, help="requests per mix")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--replay", help="JSONL capture to replay after the mixes")
+    parser.add_argument("--out", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare results against this JSON file")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write the results to --baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    db_path = args.db
+    if db_path is None:
+        sizes = dict(SCALES[args.scale])
+        for table in sizes:
+            override = getattr(args, table)
+            if override is not None:
+                sizes[table] = override
+        db_path = generate_db(
+            os.path.join(tempfile.mkdtemp(prefix="trippy-bench-"), "trippy.db"),
+            sizes, args.seed)
+    # must be set before db_utils is imported, it opens its pool on import
+    os.environ["TRIPPY_DB_PATH"] = db_path
+    suites = args.suite.split(",")
+
+    results = {}
+    if "micro" in suites:
+        import db_utils
+        from benchmarks.micro import run_micro
+        results["micro"] = run_micro(db_utils, args.iterations, args.seed)
+    if "load" in suites:
+        from benchmarks.load import run_load
+        results["load"] = asyncio.run(run_load(
+            args.mix.split(","), args.requests, args.concurrency,
+            args.seed, args.replay))
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    elif args.baseline:
+        regressions = compare(results, load_json(args.baseline), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
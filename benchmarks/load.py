@@ -0,0 +1,146 @@
+'''Drive main.app in-process through httpx's ASGI transport.
+
+A mix is a weighted list of request generators. `concurrency` workers send
+requests from the mix until `requests` have been issued. Replays read
+recorded traffic from a JSONL file with one request per line:
+{"method": "GET", "path": "/package/country", "params": {...}, "json": {...}}
+'''
+import asyncio
+import json
+import random
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from benchmarks.micro import sample_context
+from benchmarks.stats import summarize
+from benchmarks.synth_db import BENCH_PASSWORD
+
+# (method, path, query params, json body)
+Request = Tuple[str, str, Optional[Dict], Optional[Dict]]
+Generator = Callable[[Dict], Request]
+
+
+def _browse(ctx: Dict) -> List[Tuple[int, Generator]]:
+    pick = lambda key: ctx["rng"].choice(ctx[key])
+    return [
+        (30, lambda ctx: ("GET", "/package/popular", {"batch": 8}, None)),
+        (20, lambda ctx: ("GET", "/package/country", {"country": pick("countries")}, None)),
+        (20, lambda ctx: ("GET", "/package/destination", {"destination": pick("destinations")}, None)),
+        (10, lambda ctx: ("GET", "/info/company", None, None)),
+        (10, lambda ctx: ("GET", "/hotel/available", {"destination": pick("destinations")}, None)),
+        (5, lambda ctx: ("GET", "/guide/available", {"undesired_guide_ids": [pick("guide_ids")]}, None)),
+        (5, lambda ctx: ("GET", "/user/orders", {"username": pick("usernames")}, None)),
+    ]
+
+
+def _logins(ctx: Dict) -> List[Tuple[int, Generator]]:
+    pick = lambda key: ctx["rng"].choice(ctx[key])
+    return [
+        (70, lambda ctx: ("POST", "/user/login", None,
+                          {"username": pick("usernames"), "password": BENCH_PASSWORD})),
+        (20, lambda ctx: ("POST", "/user/login", None,
+                          {"username": pick("usernames"), "password": "wrong"})),
+        (10, lambda ctx: ("GET", "/user/checkname", {"username": f"new-{ctx['rng'].random()}"}, None)),
+    ]
+
+
+def _orders(ctx: Dict) -> List[Tuple[int, Generator]]:
+    pick = lambda key: ctx["rng"].choice(ctx[key])
+    return [
+        (40, lambda ctx: ("POST", "/order", None,
+                          {"username": pick("usernames"), "package_id": pick("package_ids")})),
+        (30, lambda ctx: ("DELETE", "/order/cancel",
+                          {"username": pick("usernames"), "destination": pick("destinations")}, None)),
+        (15, lambda ctx: ("PUT", "/user/order/hotel",
+                          {"username": pick("usernames"), "destination": pick("destinations"),
+                           "hotel_id": pick("hotel_ids")}, None)),
+        (15, lambda ctx: ("PUT", "/user/order/guide",
+                          {"username": pick("usernames"), "destination": pick("destinations")}, None)),
+    ]
+
+
+MIXES: Dict[str, Callable[[Dict], List[Tuple[int, Generator]]]] = {
+    "browse": _browse,
+    "login": _logins,
+    "orders": _orders,
+}
+
+
+def mix_requests(mix: str, ctx: Dict, count: int) -> List[Request]:
+    generators = MIXES[mix](ctx)
+    weights = [weight for weight, _ in generators]
+    chosen = ctx["rng"].choices([gen for _, gen in generators], weights, k=count)
+    return [gen(ctx) for gen in chosen]
+
+
+def read_capture(path: str) -> List[Request]:
+    '''requests from a JSONL capture; lines that are not requests are skipped'''
+    requests = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and "method" in entry and "path" in entry:
+                requests.append((entry["method"].upper(), entry["path"],
+                                 entry.get("params"), entry.get("json")))
+    return requests
+
+
+async def drive(
+    app, requests: List[Request], concurrency: int, base_url: str = "http://bench") -> Dict:
+    '''send `requests` to the ASGI `app`, or over HTTP to `base_url` if app is None'''
+    queue: "asyncio.Queue[Request]" = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+    latencies: List[float] = []
+    errors = 0
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal errors
+        while True:
+            try:
+                method, path, params, body = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            t = time.perf_counter()
+            try:
+                response = await client.request(method, path, params=params, json=body)
+                if response.status_code >= 500:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - t)
+
+    transport = httpx.ASGITransport(app=app) if app is not None else None
+    async with httpx.AsyncClient(transport=transport, base_url=base_url) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return summarize(latencies, elapsed, errors)
+
+
+async def run_load(
+    mixes: List[str],
+    requests: int,
+    concurrency: int,
+    seed: int = 0,
+    capture: Optional[str] = None) -> Dict:
+    import db_utils
+    import main
+
+    results = {}
+    # ASGITransport does not send lifespan events, run the app lifespan here
+    async with main.lifespan(main.app):
+        ctx = sample_context(db_utils, random.Random(seed))
+        for mix in mixes:
+            results[mix] = await drive(
+                main.app, mix_requests(mix, ctx, requests), concurrency)
+        if capture:
+            results["replay"] = await drive(main.app, read_capture(capture), concurrency)
+    return results
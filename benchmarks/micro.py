@@ -0,0 +1,100 @@
+'''Micro-benchmarks of the db_utils functions.
+
+Cached getters are measured through `__wrapped__`, i.e. the SQL path
+without the read-through cache in front of it.
+'''
+import random
+import time
+from typing import Callable, Dict, List, Tuple
+
+from benchmarks.stats import summarize
+from fieldsets import PackageFields
+
+# what a list view asks for: ?fields=title,pic_url
+LIST_VIEW_FIELDS = PackageFields(("title", "pic_url"), ())
+
+
+def sample_context(db_utils, rng: random.Random) -> Dict:
+    with db_utils.pool.connection() as conn:
+        column = lambda sql: [row[0] for row in conn.execute(sql)]
+        return {
+            "rng": rng,
+            "package_ids": column("SELECT id FROM package"),
+            "countries": column("SELECT DISTINCT country FROM package"),
+            "destinations": column("SELECT DISTINCT destination FROM package"),
+            "hotel_ids": column("SELECT id FROM hotel"),
+            "guide_ids": column("SELECT id FROM guide"),
+            "flight_ids": column("SELECT id FROM flight"),
+            "usernames": column("SELECT name FROM user LIMIT 1000"),
+        }
+
+
+def benchmarks(db_utils) -> List[Tuple[str, Callable[[Dict], object]]]:
+    raw = lambda fn: getattr(fn, "__wrapped__", fn)
+    pick = lambda ctx, key: ctx["rng"].choice(ctx[key])
+
+    def order_round_trip(ctx):
+        username = f"bench-{ctx['rng'].random()}"
+        package_id = pick(ctx, "package_ids")
+        db_utils.create_order(username, package_id)
+        db_utils.delete_order(username, package_id)
+
+    def nearest_to_hotel(ctx):
+        hotel = db_utils.db_get_hotel_by_id(pick(ctx, "hotel_ids"))
+        db_utils.get_nearest_restaurants(hotel.destination, 5, hotel_id=hotel.id)
+
+    return [
+        ("db_get_info", lambda ctx: raw(db_utils.db_get_info)("company_info")),
+        ("db_get_package_by_id", lambda ctx: raw(db_utils.db_get_package_by_id)(
+            pick(ctx, "package_ids"))),
+        ("db_get_popular_packages_page", lambda ctx: raw(db_utils.db_get_popular_packages_page)(
+            8, [pick(ctx, "package_ids")])),
+        ("db_get_trending_packages", lambda ctx: raw(db_utils.db_get_trending_packages)(10)),
+        ("db_get_packages_by_country", lambda ctx: raw(db_utils.db_get_packages_by_country)(
+            pick(ctx, "countries"))),
+        ("db_get_packages_by_country_list_view", lambda ctx: raw(db_utils.db_get_packages_by_country)(
+            pick(ctx, "countries"), LIST_VIEW_FIELDS)),
+        ("db_get_packages_by_destination", lambda ctx: raw(db_utils.db_get_packages_by_destination)(
+            pick(ctx, "destinations"))),
+        ("db_search_packages", lambda ctx: raw(db_utils.db_search_packages)(
+            pick(ctx, "countries")[:3])),
+        ("db_query_packages", lambda ctx: raw(db_utils.db_query_packages)(
+            pick(ctx, "countries"), None, 500, 2500, 5, 15)),
+        ("db_get_hotels_by_destination", lambda ctx: raw(db_utils.db_get_hotels_by_destination)(
+            pick(ctx, "destinations"))),
+        ("db_get_hotel_by_id", lambda ctx: raw(db_utils.db_get_hotel_by_id)(
+            pick(ctx, "hotel_ids"))),
+        ("get_available_guide", lambda ctx: db_utils.get_available_guide(
+            [pick(ctx, "guide_ids")])),
+        ("get_available_hotel", lambda ctx: db_utils.get_available_hotel(
+            pick(ctx, "destinations"), [pick(ctx, "hotel_ids")])),
+        ("get_available_flight", lambda ctx: db_utils.get_available_flight(
+            [pick(ctx, "flight_ids")])),
+        ("get_nearest_restaurant", lambda ctx: db_utils.get_nearest_restaurant(
+            pick(ctx, "destinations"), "")),
+        ("get_nearest_restaurants", nearest_to_hotel),
+        ("get_user", lambda ctx: db_utils.get_user(pick(ctx, "usernames"))),
+        ("get_packages_by_username", lambda ctx: raw(db_utils.get_packages_by_username)(
+            pick(ctx, "usernames"))),
+        ("get_itinerary", lambda ctx: raw(db_utils.get_itinerary)(pick(ctx, "usernames"))),
+        ("get_package_id_by_destination", lambda ctx: raw(db_utils.get_package_id_by_destination)(
+            pick(ctx, "destinations"))),
+        ("create_and_delete_order", order_round_trip),
+    ]
+
+
+def run_micro(db_utils, iterations: int, seed: int = 0, only: List[str] = None) -> Dict:
+    ctx = sample_context(db_utils, random.Random(seed))
+    results = {}
+    for name, bench in benchmarks(db_utils):
+        if only and name not in only:
+            continue
+        bench(ctx)  # warm up connection, statement cache and page cache
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(iterations):
+            t = time.perf_counter()
+            bench(ctx)
+            latencies.append(time.perf_counter() - t)
+        results[name] = summarize(latencies, time.perf_counter() - started)
+    return results
@@ -0,0 +1,136 @@
+'''Check that the statements db_utils runs are served by indexes.
+
+    python -m benchmarks.plans --scale small
+
+Generates a migrated synthetic database, runs every micro-benchmark and
+the read paths below once, with the caches off, and records each statement
+through the instrumentation hook. Each distinct statement is then EXPLAINed
+with the parameters it ran with. A statement reading a whole table (see
+migrations.uses_index) is a failure, and the run exits with status 1.
+Statements that sort or group the rows found by index searches are listed
+for information.
+'''
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from typing import Any, Callable, Dict, List, Tuple
+
+from benchmarks.synth_db import SCALES, generate_db
+
+# statements that cannot be planned on their own, or have no plan to check
+SKIPPED_PREFIXES = ("INSERT", "PRAGMA", "BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+
+def read_paths(db_utils) -> List[Tuple[str, Callable[[Dict], Any]]]:
+    '''read paths and variants the micro-benchmarks do not cover'''
+    from fieldsets import PackageFields
+
+    pick = lambda ctx, key: ctx["rng"].choice(ctx[key])
+    list_view = PackageFields(("title", "pic_url"), ("hotel",))
+
+    def popular_without_ranking(ctx):
+        ranking_size, db_utils.RANKING_SIZE = db_utils.RANKING_SIZE, 0
+        try:
+            _, cursor = db_utils.db_get_popular_packages_page(4, [pick(ctx, "package_ids")])
+            db_utils.db_get_popular_packages_page(4, [], cursor, list_view)
+        finally:
+            db_utils.RANKING_SIZE = ranking_size
+
+    def query_variants(ctx):
+        country = pick(ctx, "countries")
+        for sort in db_utils.PACKAGE_SORTS:
+            db_utils.db_query_packages(sort=sort, descending=sort == "num_of_sales")
+            db_utils.db_query_packages(country, sort=sort)
+            db_utils.db_query_packages(min_price=1000, max_price=1500, sort=sort)
+            db_utils.db_query_packages(min_duration=5, max_duration=8, sort=sort)
+        db_utils.db_query_packages(destination=pick(ctx, "destinations"), fields=list_view)
+
+    def order_changes(ctx):
+        username = f"plans-{ctx['rng'].random()}"
+        package_id = pick(ctx, "package_ids")
+        order = db_utils.create_order(username, package_id)
+        destination = db_utils.db_get_package_by_id(package_id).destination
+        db_utils.get_user_order(username, destination)
+        db_utils.change_user_guide(order)
+        db_utils.change_user_hotel(order, pick(ctx, "hotel_ids"))
+        db_utils.change_user_flight(order, pick(ctx, "flight_ids"))
+        db_utils.delete_order(username, package_id)
+
+    return [
+        ("popular_without_ranking", popular_without_ranking),
+        ("query_variants", query_variants),
+        ("search_list_view", lambda ctx: db_utils.db_search_packages(
+            pick(ctx, "countries")[:3], fields=list_view)),
+        ("packages_by_ids_list_view", lambda ctx: db_utils.db_get_packages_by_ids(
+            ctx["package_ids"][:20], list_view)),
+        ("iter_packages_by_country", lambda ctx: list(db_utils.iter_packages_by_country(
+            pick(ctx, "countries"), fields=list_view))),
+        ("iter_packages_by_destination", lambda ctx: list(db_utils.iter_packages_by_destination(
+            pick(ctx, "destinations")))),
+        ("iter_packages_by_username", lambda ctx: list(db_utils.iter_packages_by_username(
+            pick(ctx, "usernames")))),
+        ("db_get_trending_packages", lambda ctx: db_utils.db_get_trending_packages(10, list_view)),
+        ("order_changes", order_changes),
+    ]
+
+
+def collect_statements(db_utils, seed: int = 0) -> Dict[str, Tuple[str, Any]]:
+    '''run the workload once and return {statement shape: (sql, parameters)}'''
+    import cache
+    import instrumentation
+    from instrumentation import normalize_sql
+    from benchmarks.micro import benchmarks, sample_context
+
+    statements: Dict[str, Tuple[str, Any]] = {}
+
+    # one entry per statement shape, with its shortest IN (...) list: a list
+    # naming most rows of a small table is rightly planned as a scan
+    def record(sql: str, parameters: Any) -> None:
+        if sql.lstrip().upper().startswith(SKIPPED_PREFIXES):
+            return
+        shape = normalize_sql(sql)
+        if shape not in statements or len(parameters or ()) < len(statements[shape][1] or ()):
+            statements[shape] = (sql, parameters)
+
+    cache.CACHE_ENABLED = False
+    ctx = sample_context(db_utils, random.Random(seed))
+    instrumentation.add_statement_listener(record)
+    for _, run in benchmarks(db_utils) + read_paths(db_utils):
+        run(ctx)
+    return statements
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.plans")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    db_path = generate_db(
+        os.path.join(tempfile.mkdtemp(prefix="trippy-plans-"), "trippy.db"),
+        SCALES[args.scale], args.seed)
+    # must be set before db_utils is imported, it opens its pool on import
+    os.environ["TRIPPY_DB_PATH"] = db_path
+    import db_utils
+    from migrations import explain_query_plan, uses_index
+
+    statements = collect_statements(db_utils, args.seed)
+    failures = 0
+    # a plain connection, the instrumented ones would record the EXPLAINs
+    conn = sqlite3.connect(db_path)
+    for shape, (sql, parameters) in statements.items():
+        plan = explain_query_plan(conn, sql, parameters)
+        if not uses_index(plan, sql):
+            failures += 1
+            print(f"FULL SCAN: {shape}\n    {plan}")
+        elif any("TEMP B-TREE" in detail for detail in plan):
+            print(f"sorts found rows: {shape}\n    {plan}")
+    conn.close()
+    print(f"{failures} statements read a whole table")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,46 @@
+import json
+from typing import Dict, List
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], elapsed: float, errors: int = 0) -> Dict[str, float]:
+    '''latencies in seconds -> throughput and p50/p95/p99 in milliseconds'''
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "throughput_rps": len(values) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(values, 0.50) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+    }
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    '''describe every benchmark that regressed more than `tolerance` against `baseline`'''
+    regressions = []
+    for suite, benchmarks in baseline.items():
+        for name, expected in benchmarks.items():
+            actual = results.get(suite, {}).get(name)
+            if actual is None:
+                continue
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                if actual[key] > expected[key] * (1 + tolerance):
+                    regressions.append(
+                        f"{suite}/{name} {key}: {actual[key]:.3f} > {expected[key]:.3f}")
+            if actual["throughput_rps"] < expected["throughput_rps"] * (1 - tolerance):
+                regressions.append(
+                    f"{suite}/{name} throughput_rps: "
+                    f"{actual['throughput_rps']:.1f} < {expected['throughput_rps']:.1f}")
+    return regressions
+
+
+def load_json(path: str) -> Dict:
+    with open(path) as f:
+        return json.load(f)
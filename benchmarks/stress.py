@@ -0,0 +1,117 @@
+'''Write stress test against a multi-worker gunicorn deployment.
+
+    python -m benchmarks.stress --workers 4 --requests 4000 --concurrency 64
+
+Starts `gunicorn -c gunicorn.conf.py main:app` with --workers processes on
+a synthetic database and drives a write-heavy mix over real HTTP:
+registrations, logins, order creation, order changes and cancellations.
+The run fails (exit status 1) if any request got a 5xx answer or the
+server logged a "database is locked" error.
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.load import Request, drive, mix_requests
+from benchmarks.synth_db import SCALES, generate_db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def sample_context(db_path: str, rng: random.Random) -> Dict:
+    conn = sqlite3.connect(db_path)
+    try:
+        column = lambda sql: [row[0] for row in conn.execute(sql)]
+        return {
+            "rng": rng,
+            "package_ids": column("SELECT id FROM package"),
+            "destinations": column("SELECT DISTINCT destination FROM package"),
+            "hotel_ids": column("SELECT id FROM hotel"),
+            "usernames": column("SELECT name FROM user LIMIT 1000"),
+        }
+    finally:
+        conn.close()
+
+
+def write_mix(ctx: Dict, count: int) -> List[Request]:
+    '''orders mix, with a quarter of the requests registering new users instead'''
+    requests = mix_requests("orders", ctx, count) + mix_requests("login", ctx, count // 4)
+    for i in range(count // 4):
+        requests.append(("POST", "/user/register", None,
+                         {"username": f"stress-{i}-{ctx['rng'].random()}", "password": "pw"}))
+    ctx["rng"].shuffle(requests)
+    return requests[:count]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(base_url: str, server: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("gunicorn exited during startup")
+        try:
+            if httpx.get(base_url + "/info/company").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("gunicorn did not become ready")
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.stress")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--db", help="stress this database (it is written to)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="trippy-stress-")
+    db_path = args.db or generate_db(
+        os.path.join(workdir, "trippy.db"), SCALES[args.scale], args.seed)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    log_path = os.path.join(workdir, "gunicorn.log")
+    env = dict(os.environ,
+               TRIPPY_DB_PATH=db_path,
+               TRIPPY_WORKERS=str(args.workers),
+               TRIPPY_BIND=f"127.0.0.1:{port}")
+    with open(log_path, "w") as log:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app"],
+            cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_ready(base_url, server)
+            ctx = sample_context(db_path, random.Random(args.seed))
+            result = asyncio.run(drive(
+                None, write_mix(ctx, args.requests), args.concurrency, base_url))
+        finally:
+            server.terminate()
+            server.wait()
+    with open(log_path) as log:
+        result["lock_errors"] = log.read().count("database is locked")
+    result["workers"] = args.workers
+    print(json.dumps(result, indent=2))
+    return 1 if result["errors"] or result["lock_errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,159 @@
+'''Generate a synthetic trippy.db at a configurable scale.
+
+The table definitions are copied from the bundled trippy.db and brought up
+to date with migrations.py, so the synthetic database always matches the
+schema the app runs against. Every user shares the password BENCH_PASSWORD
+so login benchmarks can authenticate.
+'''
+import os
+import random
+import sqlite3
+import time
+from typing import Dict
+
+from data import CURRENT_PASSWORD_HASH_VERSION, derive_password_key
+from migrations import apply_migrations
+
+SOURCE_DB = os.path.join(os.path.dirname(os.path.dirname(__file__)), "trippy.db")
+BENCH_PASSWORD = "bench-password"
+
+SCALES: Dict[str, Dict[str, int]] = {
+    "small": {
+        "packages": 200, "hotels": 500, "guides": 200, "car_rentals": 50,
+        "restaurants": 500, "flights": 100, "users": 1000, "orders": 2000,
+    },
+    "medium": {
+        "packages": 2000, "hotels": 5000, "guides": 2000, "car_rentals": 200,
+        "restaurants": 5000, "flights": 1000, "users": 10000, "orders": 20000,
+    },
+    "large": {
+        "packages": 20000, "hotels": 50000, "guides": 20000, "car_rentals": 1000,
+        "restaurants": 50000, "flights": 10000, "users": 100000, "orders": 200000,
+    },
+}
+COUNTRIES = [
+    "Czech Republic", "Japan", "Italy", "France", "Finland", "South Korean",
+    "Spain", "Portugal", "Greece", "Norway", "Thailand", "Mexico",
+]
+
+
+def destinations_of(country: str, count: int = 8):
+    return [f"{country} City {i}" for i in range(count)]
+
+
+def copy_schema(conn: sqlite3.Connection, source_db: str = SOURCE_DB) -> None:
+    '''tables, indexes, triggers and schema version of `source_db`, without rows'''
+    with sqlite3.connect(source_db) as source:
+        objects = source.execute("""
+            SELECT type, name, sql FROM sqlite_master
+            WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+            ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END
+        """).fetchall()
+        version = source.execute("PRAGMA user_version").fetchone()[0]
+    # the shadow tables of virtual tables (e.g. FTS5) are created with them
+    virtual = [name for _, name, sql in objects if sql.upper().startswith("CREATE VIRTUAL")]
+    for kind, name, sql in objects:
+        if kind == "table" and any(name.startswith(v + "_") for v in virtual):
+            continue
+        conn.execute(sql)
+    conn.execute(f"PRAGMA user_version={int(version)}")
+    conn.commit()
+
+
+def generate_db(path: str, sizes: Dict[str, int], seed: int = 0) -> str:
+    '''(re)create `path` filled with synthetic rows and return it'''
+    rng = random.Random(seed)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    conn = sqlite3.connect(path)
+    copy_schema(conn)
+    apply_migrations(conn)
+
+    destinations = [
+        (country, destination)
+        for country in COUNTRIES for destination in destinations_of(country)
+    ]
+    centers = {
+        destination: (rng.uniform(-50, 60), rng.uniform(-120, 140))
+        for _, destination in destinations
+    }
+    # within ~10 km of the destination centre
+    near = lambda destination: (
+        centers[destination][0] + rng.gauss(0, 0.05),
+        centers[destination][1] + rng.gauss(0, 0.05))
+    conn.executemany("INSERT INTO info VALUES (?, ?)", [
+        ("company_info", "Trippy is a synthetic travel company. " * 8),
+        ("company_contact", "bench@trippy.social"),
+    ])
+    conn.executemany(
+        "INSERT INTO car_rental (id, name, price) VALUES (?, ?, ?)",
+        [(i, f"Car Rental {i}", rng.uniform(30, 150))
+         for i in range(1, sizes["car_rentals"] + 1)])
+    conn.executemany(
+        "INSERT INTO guide (id, name, phone_number, email) VALUES (?, ?, ?, ?)",
+        [(i, f"Guide {i}", f"+1-555-{i:07d}", f"guide{i}@trippy.social")
+         for i in range(1, sizes["guides"] + 1)])
+    hotels = []
+    for i in range(1, sizes["hotels"] + 1):
+        country, destination = rng.choice(destinations)
+        hotels.append((i, f"Hotel {i}", rng.uniform(50, 400),
+                       f"+1-556-{i:07d}", f"{i} Bench Street", destination,
+                       *near(destination)))
+    conn.executemany("""
+        INSERT INTO hotel (id, name, price, telephone, address, destination,
+            latitude, longitude)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, hotels)
+    restaurants = []
+    for i in range(1, sizes["restaurants"] + 1):
+        destination = rng.choice(destinations)[1]
+        restaurants.append((i, f"Restaurant {i}", destination, *near(destination)))
+    conn.executemany("""
+        INSERT INTO restaurant (id, name, destination, latitude, longitude)
+        VALUES (?, ?, ?, ?, ?)
+    """, restaurants)
+    conn.executemany("""
+        INSERT INTO flight (id, airline, departure_port, departure_time)
+        VALUES (?, ?, ?, ?)
+    """, [(i, f"Airline {i % 17}", rng.randint(1, 40), str(rng.randint(0, 23)))
+          for i in range(1, sizes["flights"] + 1)])
+    packages = []
+    for i in range(1, sizes["packages"] + 1):
+        country, destination = destinations[i % len(destinations)]
+        packages.append((
+            i, f"Package {i} to {destination}", country, destination,
+            rng.randint(3, 21), round(rng.uniform(400, 4000), -1),
+            "A synthetic package description. " * rng.randint(5, 30),
+            rng.randint(0, 500), rng.randint(1, sizes["hotels"]),
+            rng.randint(1, sizes["guides"]), rng.randint(1, sizes["car_rentals"]),
+            f"https://trippy.social/static/images/{i}.jpg"))
+    conn.executemany("""
+        INSERT INTO package (id, title, country, destination, duration, price,
+            description, num_of_sales, hotel_id, guide_id, car_rental_id, pic_url)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, packages)
+    # one real key derivation shared by every user keeps generation fast
+    salt = os.urandom(32)
+    key = derive_password_key(BENCH_PASSWORD, salt, CURRENT_PASSWORD_HASH_VERSION)
+    conn.executemany("""
+        INSERT INTO user (name, password_key, salt, hash_version) VALUES (?, ?, ?, ?)
+    """, [(f"user{i}", key, salt, CURRENT_PASSWORD_HASH_VERSION)
+          for i in range(sizes["users"])])
+    orders = set()
+    while len(orders) < min(sizes["orders"], sizes["users"] * sizes["packages"]):
+        orders.add((f"user{rng.randrange(sizes['users'])}",
+                    rng.randint(1, sizes["packages"])))
+    # placed over the last 30 days (as julian days), for the trending score
+    today = time.time() / 86400 + 2440587.5
+    conn.executemany("""
+        INSERT INTO 'order' (username, package_id, guide_id, hotel_id, flight_id, ordered_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(username, package_id, rng.randint(1, sizes["guides"]),
+           rng.randint(1, sizes["hotels"]), rng.randint(1, sizes["flights"]),
+           today - rng.uniform(0, 30))
+          for username, package_id in sorted(orders)])
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return path
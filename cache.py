@@ -0,0 +1,183 @@
+'''Read-through cache for catalog lookups in db_utils.
+
+Every cached function declares the tables it reads. Each cache is an LRU
+bounded by `maxsize` whose entries expire after the shortest TTL of those
+tables. Write paths call `invalidate(table)` to drop every cache that reads
+that table. Caches keyed by user are registered with `user_of`, and
+`invalidate_users(name)` drops only that user's entries. Cached values are
+shared between callers and must not be mutated. Set TRIPPY_CACHE=0 to turn
+caching off.
+'''
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+# seconds an entry may be served after it was loaded, per table
+TABLE_TTLS: Dict[str, float] = {
+    "info": 3600,
+    "package": 300,
+    "hotel": 300,
+    "guide": 300,
+    "car_rental": 300,
+    "restaurant": 300,
+    "flight": 300,
+    "order": 30,
+    # not a table: the popular ranking and trending data, dropped on every
+    # order write, while other package caches keep num_of_sales up to their TTL
+    "sales": 300,
+}
+CACHE_ENABLED = os.environ.get("TRIPPY_CACHE", "1") != "0"
+
+
+class TTLCache:
+    '''thread-safe LRU mapping whose entries expire `ttl` seconds after insertion'''
+
+    def __init__(self, name: str, maxsize: int, ttl: float) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # bumped by clear() so loads that raced an invalidation are dropped
+        self.generation = 0
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key: Hashable, value: Any, generation: int) -> None:
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def discard(self, match: Callable[[Hashable], bool]) -> None:
+        '''drop the entries whose key matches; loads in flight are not stored'''
+        with self._lock:
+            self.generation += 1
+            for key in [key for key in self._data if match(key)]:
+                del self._data[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+        }
+
+
+_caches: Dict[str, TTLCache] = {}
+_caches_by_table: Dict[str, List[TTLCache]] = {}
+_invalidation_listeners: List[Callable[[Tuple[str, ...]], None]] = []
+# caches keyed by user, with the function returning the user of a key
+_user_caches: List[Tuple[TTLCache, Callable[[Hashable], str]]] = []
+
+
+def _freeze(value: Any) -> Hashable:
+    '''turn list arguments (e.g. id lists) into hashable cache keys'''
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def register(
+    name: str,
+    tables: Iterable[str],
+    maxsize: int = 256,
+    user_of: Optional[Callable[[Hashable], str]] = None) -> TTLCache:
+    '''new cache cleared by `invalidate` on any of `tables`, and by
+    `invalidate_users` for the keys whose `user_of(key)` is listed'''
+    tables = tuple(tables)
+    cache = TTLCache(name, maxsize, min(TABLE_TTLS[t] for t in tables))
+    _caches[name] = cache
+    for table in tables:
+        _caches_by_table.setdefault(table, []).append(cache)
+    if user_of is not None:
+        _user_caches.append((cache, user_of))
+    return cache
+
+
+def first_argument(key: Hashable) -> Any:
+    '''user_of for @cached getters taking the username as first argument'''
+    return key[0][0]
+
+
+def cached(
+    name: str,
+    tables: Iterable[str],
+    maxsize: int = 256,
+    user_of: Optional[Callable[[Hashable], str]] = None) -> Callable:
+    '''decorate a db_utils getter with a cache that depends on `tables`'''
+    cache = register(name, tables, maxsize, user_of)
+
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not CACHE_ENABLED:
+                return fn(*args, **kwargs)
+            key = (_freeze(args), _freeze(sorted(kwargs.items())))
+            found, value = cache.get(key)
+            if found:
+                return value
+            generation = cache.generation
+            value = fn(*args, **kwargs)
+            cache.set(key, value, generation)
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+def invalidate(*tables: str) -> None:
+    '''drop every cached value read from one of `tables`'''
+    for table in tables:
+        for cache in _caches_by_table.get(table, []):
+            cache.clear()
+    for listener in _invalidation_listeners:
+        listener(tables)
+
+
+def invalidate_users(*usernames: str) -> None:
+    '''drop the entries of `usernames` from the caches keyed by user'''
+    names = set(usernames)
+    if not names:
+        return
+    for cache, user_of in _user_caches:
+        cache.discard(lambda key: user_of(key) in names)
+
+
+def add_invalidation_listener(listener: Callable[[Tuple[str, ...]], None]) -> None:
+    '''call `listener(tables)` whenever `invalidate` runs'''
+    _invalidation_listeners.append(listener)
+
+
+def clear_all() -> None:
+    for cache in _caches.values():
+        cache.clear()
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: cache.stats() for name, cache in _caches.items()}
@@ -0,0 +1,181 @@
+'''Memory-resident snapshot of the catalog tables.
+
+With TRIPPY_CATALOG_SNAPSHOT=1 the catalog tables (info, package, hotel,
+guide, car_rental, restaurant, flight) are loaded at startup into plain
+dicts indexed by id, country and destination, with package attachments
+already joined, and db_utils serves its catalog reads from there without
+any SQL. A background thread watches the `catalog_version` counter that the
+triggers of migration 8 bump on catalog writes. When it changes, or once
+the snapshot is as old as the package cache TTL, the thread rebuilds the
+snapshot and swaps it in with a single reference assignment, so readers
+always see either the old or the new snapshot, never a mix.
+
+Order writes only update `package.num_of_sales`, which does not bump the
+counter, so the counts in the snapshot may lag by up to that TTL. The
+popular page is cut from db_utils.ranking, which follows every order.
+'''
+import bisect
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from cache import TABLE_TTLS
+from data import CarRental, Flight, Guide, Hotel, Package, Restaurant
+from row_mapping import model_cursor
+
+logger = logging.getLogger("trippy.catalog")
+
+CATALOG_TABLES = ("info", "package", "hotel", "guide", "car_rental", "restaurant", "flight")
+SNAPSHOT_ENABLED = os.environ.get("TRIPPY_CATALOG_SNAPSHOT", "0") == "1"
+RELOAD_INTERVAL = float(os.environ.get("TRIPPY_CATALOG_RELOAD_INTERVAL", 1.0))
+# rebuilt at least this often, for the num_of_sales counts
+MAX_AGE = TABLE_TTLS["package"]
+
+
+def _by_id(conn: sqlite3.Connection, table: str, model: type) -> Dict[int, object]:
+    cur = model_cursor(conn, model)
+    cur.execute(f"SELECT * FROM {table} ORDER BY id")
+    return {obj.id: obj for obj in cur.fetchall()}
+
+
+def _group(items, key: Callable) -> Dict[str, List]:
+    groups: Dict[str, List] = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return groups
+
+
+def sample_available(candidates: List, undesired_ids: List[int]):
+    '''uniformly random candidate whose id is not undesired, or None'''
+    undesired = set(undesired_ids)
+    if len(undesired) < len(candidates) // 2:
+        # rejection sampling, a handful of draws when few ids are excluded
+        for _ in range(8):
+            candidate = random.choice(candidates)
+            if candidate.id not in undesired:
+                return candidate
+    available = [c for c in candidates if c.id not in undesired]
+    return random.choice(available) if available else None
+
+
+class CatalogSnapshot:
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        # one read transaction: every table, and the version, as of one commit
+        conn.execute("BEGIN")
+        try:
+            self.version: int = conn.execute(
+                "SELECT version FROM catalog_version").fetchone()[0]
+            self.info: Dict[str, str] = dict(
+                conn.execute("SELECT info_name, info_content FROM info").fetchall())
+            self.hotels: Dict[int, Hotel] = _by_id(conn, "hotel", Hotel)
+            self.guides: Dict[int, Guide] = _by_id(conn, "guide", Guide)
+            self.car_rentals: Dict[int, CarRental] = _by_id(conn, "car_rental", CarRental)
+            self.restaurants: Dict[int, Restaurant] = _by_id(conn, "restaurant", Restaurant)
+            self.flights: Dict[int, Flight] = _by_id(conn, "flight", Flight)
+            self.packages: Dict[int, Package] = _by_id(conn, "package", Package)
+        finally:
+            conn.commit()
+        for package in self.packages.values():
+            package.hotel = self.hotels.get(package.hotel_id)
+            package.guide = self.guides.get(package.guide_id)
+            package.car_rental = self.car_rentals.get(package.car_rental_id)
+
+        packages = list(self.packages.values())
+        self.packages_by_country = _group(packages, lambda p: p.country)
+        self.packages_by_destination = _group(packages, lambda p: p.destination)
+        self.package_ids_by_destination = {
+            destination: group[0].id
+            for destination, group in self.packages_by_destination.items()
+        }
+        self.hotels_by_destination = _group(self.hotels.values(), lambda h: h.destination)
+        self.restaurants_by_destination = _group(
+            self.restaurants.values(), lambda r: r.destination)
+        self.guide_list = list(self.guides.values())
+        self.flight_list = list(self.flights.values())
+        # popular ranking: num_of_sales DESC, id DESC, as ascending sort keys
+        self.popular = sorted(packages, key=lambda p: (-int(p.num_of_sales), -p.id))
+        self._popular_keys = [(-int(p.num_of_sales), -p.id) for p in self.popular]
+
+    def popular_page(
+        self,
+        batch: int,
+        showed_package_ids: List[int],
+        after: Optional[Tuple[int, int]] = None) -> List[Package]:
+        '''same rows as the keyset query in db_get_popular_packages_page'''
+        start = 0
+        if after is not None:
+            num_of_sales, package_id = after
+            start = bisect.bisect_right(self._popular_keys, (-num_of_sales, -package_id))
+        showed = set(showed_package_ids)
+        page = []
+        for package in self.popular[start:]:
+            if len(page) >= batch:
+                break
+            if package.id not in showed:
+                page.append(package)
+        return page
+
+
+class CatalogStore:
+    '''holds the current snapshot and rebuilds it when the database changes'''
+
+    def __init__(self) -> None:
+        self.current: Optional[CatalogSnapshot] = None
+        self._on_swap: List[Callable[[], None]] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def on_swap(self, callback: Callable[[], None]) -> None:
+        '''call `callback()` after every new snapshot is swapped in'''
+        self._on_swap.append(callback)
+
+    def _version(self, conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT version FROM catalog_version").fetchone()[0]
+
+    def reload(self, conn: sqlite3.Connection) -> CatalogSnapshot:
+        snapshot = CatalogSnapshot(conn)
+        self.current = snapshot
+        for callback in self._on_swap:
+            callback()
+        return snapshot
+
+    def start(
+        self, db_path: str, interval: float = RELOAD_INTERVAL, max_age: float = MAX_AGE) -> None:
+        '''load the first snapshot now and keep it fresh from a daemon thread'''
+        self._stop.clear()
+        # the watcher owns this connection
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        version = self.reload(conn).version
+        self._thread = threading.Thread(
+            target=self._watch, args=(conn, version, interval, max_age),
+            name="catalog-snapshot", daemon=True)
+        self._thread.start()
+
+    def _watch(
+        self, conn: sqlite3.Connection, version: int, interval: float, max_age: float) -> None:
+        loaded_at = time.monotonic()
+        try:
+            while not self._stop.wait(interval):
+                try:
+                    if self._version(conn) != version or time.monotonic() - loaded_at >= max_age:
+                        loaded_at = time.monotonic()
+                        version = self.reload(conn).version
+                except sqlite3.Error:
+                    logger.exception("catalog snapshot reload failed, keeping the old one")
+        finally:
+            conn.close()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.current = None
+
+
+catalog = CatalogStore()
@@ -21,6 +21,8 @@ class Hotel(BaseModel):
     telephone: str
     address: str
     destination: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 class Hotel(BaseModel):
     id: int
@@ -29,11 +31,15 @@ class Hotel(BaseModel):
     telephone: str
     address: str
     destination: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 class Restaurant(BaseModel):
     id: int
     name: str
     destination: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 class Info(BaseModel):
     info_name: str
@@ -63,25 +69,46 @@ class Attachment(Enum):
     car_rental = CarRental
 
 import hashlib
+import hmac
 import os
 
+# version -> (hash_name, iterations). Rows keep the version they were hashed
+# with, so adding a stronger version never invalidates stored password keys.
+PASSWORD_HASH_VERSIONS = {
+    1: ('sha256', 100000),
+}
+CURRENT_PASSWORD_HASH_VERSION = int(os.environ.get(
+    'TRIPPY_PASSWORD_HASH_VERSION', max(PASSWORD_HASH_VERSIONS)))
+
+
+def derive_password_key(password: str, salt: bytes, version: int) -> bytes:
+    hash_name, iterations = PASSWORD_HASH_VERSIONS[version]
+    return hashlib.pbkdf2_hmac(
+        hash_name, password.encode('utf-8'), salt, iterations)
+
+
 class User(BaseModel):
 
     name: str
     password_key: Optional[bytes] = None
     salt: Optional[bytes] = None
+    hash_version: int = 1
 
-    def generate_password_key(self, password: str) -> str:
+    def generate_password_key(
+        self, password: str, version: int = CURRENT_PASSWORD_HASH_VERSION) -> str:
         self.salt = os.urandom(32)
-        self.password_key = hashlib.pbkdf2_hmac(
-            'sha256', password.encode('utf-8'), self.salt, 100000)
+        self.hash_version = version
+        self.password_key = derive_password_key(password, self.salt, version)
         return self.password_key
 
     
     def validate_key(self, key: str) -> bool:
-        return hashlib.pbkdf2_hmac(
-            'sha256', key.encode('utf-8'), self.salt, 100000) \
-            == self.password_key
+        # constant time, so response times do not reveal how much of the key matched
+        return hmac.compare_digest(
+            derive_password_key(key, self.salt, self.hash_version), self.password_key)
+
+    def needs_rehash(self) -> bool:
+        return self.hash_version != CURRENT_PASSWORD_HASH_VERSION
 
 
 class Order(BaseModel):
@@ -97,3 +124,13 @@ class Flight(BaseModel):
     airline: str
     departure_port: int
     departure_time: str
+
+
+# one order of a user with the hotel, guide and flight booked on it; the
+# attachments of `package` itself are left unset
+class Itinerary(BaseModel):
+    package: Package
+    hotel: Optional[Hotel] = None
+    guide: Optional[Guide] = None
+    flight: Optional[Flight] = None
+    car_rental: Optional[CarRental] = None
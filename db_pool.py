@@ -0,0 +1,98 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+
+class ConnectionPool:
+    '''Hand out one long-lived sqlite3 connection per thread.
+
+    Connections are configured once when they are created (WAL journal,
+    synchronous level, page cache, mmap and busy timeout) and kept open so
+    the page cache survives between requests. `close_all` is called from
+    the app lifespan on shutdown.
+    '''
+
+    def __init__(
+        self,
+        db_path: str,
+        journal_mode: str = "WAL",
+        synchronous: str = "NORMAL",
+        cache_size: int = -16000,
+        mmap_size: int = 64 * 1024 * 1024,
+        busy_timeout: float = 5.0,
+        factory: type = sqlite3.Connection) -> None:
+        self.db_path = db_path
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        self.factory = factory
+        self._connections: Dict[int, sqlite3.Connection] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        # connections are only ever used by the thread that owns them, but
+        # close_all runs on the main thread at shutdown
+        conn = sqlite3.connect(
+            self.db_path, timeout=self.busy_timeout, check_same_thread=False,
+            factory=self.factory)
+        conn.executescript(f"""
+            PRAGMA journal_mode={self.journal_mode};
+            PRAGMA synchronous={self.synchronous};
+            PRAGMA cache_size={int(self.cache_size)};
+            PRAGMA mmap_size={int(self.mmap_size)};
+            PRAGMA busy_timeout={int(self.busy_timeout * 1000)};
+        """)
+        return conn
+
+    def get(self) -> sqlite3.Connection:
+        '''get the connection owned by the calling thread, opening it if needed'''
+        ident = threading.get_ident()
+        conn = self._connections.get(ident)
+        if conn is None:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("connection pool is closed")
+                conn = self._connect()
+                self._connections[ident] = conn
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        '''drop-in replacement for `with sqlite3.connect(DB_PATH) as conn`'''
+        conn = self.get()
+        with conn:
+            yield conn
+
+    @contextmanager
+    def dedicated(self) -> Iterator[sqlite3.Connection]:
+        '''a configured connection of its own, for cursors that outlive one call
+
+        Streaming readers advance their cursor from whichever worker thread
+        asks for the next chunk, so they cannot borrow a per-thread one.
+        '''
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def open(self) -> None:
+        '''allow connections again after `close_all`'''
+        with self._lock:
+            self._closed = False
+
+    def close_all(self) -> None:
+        with self._lock:
+            self._closed = True
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+
+    def size(self) -> int:
+        return len(self._connections)
+
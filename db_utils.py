@@ -1,13 +1,48 @@
+import base64
+import binascii
+import json
+import os
+import re
 import sqlite3
-from typing import List, Tuple, Generic, TypeVar
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from data import *
 import random
-
-DB_PATH = 'trippy.db'
-DataT = TypeVar("DataT")
-
+from db_pool import ConnectionPool
+from cache import (
+    TABLE_TTLS, add_invalidation_listener, cached, first_argument, invalidate, invalidate_users)
+from row_mapping import JoinMapper, model_cursor
+from instrumentation import InstrumentedConnection
+from catalog import catalog, sample_available
+from write_coordinator import WriteCoordinator
+from username_index import UsernameIndex
+from spatial import GridIndex
+from fieldsets import ALL_FIELDS, PackageFields
+from popularity import RANKING_SIZE, PopularRanking, trending_weights
+
+DB_PATH = os.environ.get('TRIPPY_DB_PATH', 'trippy.db')
+pool = ConnectionPool(DB_PATH, factory=InstrumentedConnection)
+writer = WriteCoordinator(pool)
+# tables a hydrated Package with attachments is read from
+PACKAGE_TABLES = ("package", "hotel", "guide", "car_rental")
+STREAM_BATCH_SIZE = 100
+# bm25 weights of the package_fts columns: title, description, country, destination
+SEARCH_WEIGHTS = (10.0, 1.0, 5.0, 5.0)
+# sort keys of db_query_packages -> package column
+PACKAGE_SORTS = {"num_of_sales": "num_of_sales", "price": "price", "duration": "duration"}
+USERNAME_INDEX_ENABLED = os.environ.get("TRIPPY_USERNAME_INDEX", "1") != "0"
+usernames = UsernameIndex()
+add_invalidation_listener(
+    lambda tables: usernames.mark_stale() if "user" in tables else None)
+ranking = PopularRanking(RANKING_SIZE, max_age=TABLE_TTLS["package"])
+add_invalidation_listener(
+    lambda tables: ranking.mark_stale() if "popularity" in tables else None)
+
+@cached("info", ["info"])
 def db_get_info(info_name: str) -> str:
-    with sqlite3.connect(DB_PATH) as conn:
+    snapshot = catalog.current
+    if snapshot is not None:
+        return snapshot.info[info_name]
+    with pool.connection() as conn:
         cur = conn.cursor()
         cur.execute("""
             select info_content from info 
@@ -16,33 +51,21 @@ def db_get_info(info_name: str) -> str:
         return cur.fetchone()[0]
 
 
-def tuple_to_dataclass(tuple: Tuple, dataT: Generic[DataT]) -> DataT:
-    '''Convert a dataset to a dict'''
-    if tuple is None:
-        return
-    field_keys = dataT.__fields__.keys()
-    d = {}
-    for i, key in enumerate(field_keys):
-        if i < len(tuple):
-            d.update({key: tuple[i]})
-    d = dataT.parse_obj(d)
-    return d
-
-
-def get_dataclass_by_id(dataclass_id: int, table_name: str, dataclass_type: Generic[DataT]) -> DataT:
+def get_dataclass_by_id(dataclass_id: int, table_name: str, dataclass_type: type) -> BaseModel:
     '''get dataclass object by using the id field in the database'''
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
+    with pool.connection() as conn:
+        cur = model_cursor(conn, dataclass_type)
         cur.execute(f"""
             select * from '{table_name}' 
             where id=:dataclass_id
         """, {"dataclass_id": dataclass_id})
-        res = cur.fetchone()
-        if res:
-            return tuple_to_dataclass(res, dataclass_type)
-        return None
+        return cur.fetchone()
 
+@cached("flight_by_id", ["flight"])
 def db_get_flight_by_id(flight_id: int) -> Flight:
+    snapshot = catalog.current
+    if snapshot is not None:
+        return snapshot.flights.get(flight_id)
     return get_dataclass_by_id(flight_id, 'flight', Flight)
 
 
@@ -51,28 +74,40 @@ def db_get_attachment_by_id(
     attachment_id: int, 
     attachment: Attachment) -> Attachment:
     '''use the foreign key to get related data'''
+    cur = model_cursor(cur.connection, attachment.value)
     cur.execute(f"""
         SELECT * FROM {attachment.name} WHERE id=:attachment_id 
         LIMIT 1
     """, {"attachment_id": attachment_id})
-        
-    return tuple_to_dataclass(cur.fetchone(), attachment.value)
+    return cur.fetchone()
 
 
+@cached("hotel_by_id", ["hotel"])
 def db_get_hotel_by_id(id: int) -> Hotel:
-    with sqlite3.connect(DB_PATH) as conn:
+    snapshot = catalog.current
+    if snapshot is not None:
+        return snapshot.hotels.get(id)
+    with pool.connection() as conn:
         cur = conn.cursor()
         return db_get_attachment_by_id(cur, id, Attachment.hotel)
 
 
+@cached("guide_by_id", ["guide"])
 def db_get_guide_by_id(id: int) -> Guide:
-    with sqlite3.connect(DB_PATH) as conn:
+    snapshot = catalog.current
+    if snapshot is not None:
+        return snapshot.guides.get(id)
+    with pool.connection() as conn:
         cur = conn.cursor()
         return db_get_attachment_by_id(cur, id, Attachment.guide)
 
 
+@cached("car_rental_by_id", ["car_rental"])
 def db_get_car_rental_by_id(id: int) -> CarRental:
-    with sqlite3.connect(DB_PATH) as conn:
+    snapshot = catalog.current
+    if snapshot is not None:
+        return snapshot.car_rentals.get(id)
+    with pool.connection() as conn:
         cur = conn.cursor()
         return db_get_attachment_by_id(cur, id, Attachment.car_rental)
 
@@ -93,141 +128,524 @@ def set_package_attachment(
     package.car_rental = db_get_attachment_by_package(cur, package, Attachment.car_rental)
 
 
-def db_get_popular_packages(batch: int=4, showed_package_ids: List[int]=[]) -> List[Package]:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT * FROM package 
-            Order by num_of_sales DESC 
-        """)
-        packages = []
-        for res in cur.fetchall():
-            obj = tuple_to_dataclass(res, Package)
-            set_package_attachment(obj, cur)
-            if obj.id not in showed_package_ids:
-                packages.append(obj)
-        return packages[:batch]
+def db_get_attachments_by_ids(
+    cur: sqlite3.Cursor,
+    attachment_ids: List[int],
+    attachment: Attachment) -> Dict[int, Attachment]:
+    '''load many attachments of one kind with a single IN (...) query'''
+    ids = list({i for i in attachment_ids if i is not None})
+    if len(ids) == 0:
+        return {}
+    cur = model_cursor(cur.connection, attachment.value)
+    placeholders = ",".join("?" * len(ids))
+    cur.execute(f"""
+        SELECT * FROM {attachment.name} WHERE id IN ({placeholders})
+    """, ids)
+    return {obj.id: obj for obj in cur.fetchall()}
+
 
+def set_packages_attachments(
+    packages: List[Package],
+    cur: sqlite3.Cursor,
+    attachments: Iterable[Attachment] = Attachment) -> List[Package]:
+    '''batched set_package_attachment: one query per attachment table'''
+    for attachment in attachments:
+        key = attachment.name + "_id"
+        by_id = db_get_attachments_by_ids(
+            cur, [package.__getattribute__(key) for package in packages], attachment)
+        for package in packages:
+            package.__setattr__(attachment.name, by_id.get(package.__getattribute__(key)))
+    return packages
+
+
+def fetch_packages(cur: sqlite3.Cursor, fields: PackageFields = ALL_FIELDS) -> List[Package]:
+    '''fetch the package rows of a Package cursor and load their attachments in batches'''
+    return set_packages_attachments(cur.fetchall(), cur, fields.attachments())
+
+
+def iter_packages(
+    sql: str,
+    params: Dict,
+    batch_size: int = STREAM_BATCH_SIZE,
+    fields: PackageFields = ALL_FIELDS) -> Iterator[Package]:
+    '''stream the packages of `sql`, loading attachments `batch_size` rows at a time'''
+    with pool.dedicated() as conn:
+        cur = model_cursor(conn, Package)
+        cur.execute(sql, params)
+        while True:
+            packages = cur.fetchmany(batch_size)
+            if not packages:
+                return
+            yield from set_packages_attachments(packages, cur, fields.attachments())
+
+
+def encode_popular_cursor(num_of_sales: int, package_id: int) -> str:
+    '''opaque keyset cursor pointing right after a package in the popular ranking'''
+    key = json.dumps([num_of_sales, package_id])
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def decode_popular_cursor(cursor: str) -> Tuple[int, int]:
+    '''raise ValueError if the cursor was not produced by encode_popular_cursor'''
+    try:
+        num_of_sales, package_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return int(num_of_sales), int(package_id)
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError(f"invalid cursor {cursor!r}") from e
+
+
+def popular_ranking_page(
+    batch: int,
+    showed_package_ids: List[int],
+    after: Optional[Tuple[int, int]] = None) -> Optional[List[Tuple[int, int]]]:
+    '''(num_of_sales, id) of a popular page cut from the in-memory ranking,
+    None if the ranking is disabled or too short for this page'''
+    if RANKING_SIZE <= 0:
+        return None
+    if not ranking.fresh():
+        with pool.connection() as conn:
+            ranking.refresh(conn)
+    return ranking.page(batch, showed_package_ids, after)
+
+
+@cached("popular_packages", ("sales",) + PACKAGE_TABLES)
+def db_get_popular_packages_page(
+    batch: int=4,
+    showed_package_ids: List[int]=[],
+    cursor: Optional[str]=None,
+    fields: PackageFields=ALL_FIELDS) -> Tuple[List[Package], Optional[str]]:
+    '''one page of the popular ranking plus the cursor of the next page'''
+    params = {
+        "showed": json.dumps(showed_package_ids),
+        "batch": max(batch, 0),
+    }
+    after, after_key = "", None
+    if cursor is not None:
+        after_key = decode_popular_cursor(cursor)
+        params["num_of_sales"], params["id"] = after_key
+        after = "AND (num_of_sales, id) < (:num_of_sales, :id)"
+    snapshot = catalog.current
+    # the ranking follows every order, the snapshot's num_of_sales lag behind
+    page = popular_ranking_page(params["batch"], showed_package_ids, after_key)
+    if page is None and snapshot is not None:
+        packages = snapshot.popular_page(params["batch"], showed_package_ids, after_key)
+    if page is not None:
+        packages = db_get_packages_by_ids([package_id for _, package_id in page], fields)
+    elif snapshot is None:
+        with pool.connection() as conn:
+            cur = model_cursor(conn, Package)
+            cur.execute(f"""
+                SELECT {fields.select(extra=("num_of_sales",))} FROM package
+                WHERE id NOT IN (SELECT value FROM json_each(:showed)) {after}
+                ORDER BY num_of_sales DESC, id DESC
+                LIMIT :batch
+            """, params)
+            packages = fetch_packages(cur, fields)
+    if page is None:
+        page = [(int(package.num_of_sales), package.id) for package in packages]
+    next_cursor = None
+    if len(page) == batch and batch > 0:
+        next_cursor = encode_popular_cursor(*page[-1])
+    return packages, next_cursor
+
+
+def db_get_popular_packages(batch: int=4, showed_package_ids: List[int]=[]) -> List[Package]:
+    return db_get_popular_packages_page(batch, showed_package_ids)[0]
+
+
+@cached("trending_packages", ("sales",) + PACKAGE_TABLES, maxsize=64)
+def db_get_trending_packages(
+    limit: int = 10, fields: PackageFields = ALL_FIELDS) -> List[Package]:
+    '''packages with the highest time-decayed sales, see popularity'''
+    with pool.connection() as conn:
+        package_ids = [row[0] for row in conn.execute("""
+            SELECT sales.package_id
+            FROM json_each(:weights) AS weight
+            JOIN package_sales_daily AS sales
+                ON sales.day = CAST(julianday('now') AS INTEGER) - weight.key
+            GROUP BY sales.package_id
+            ORDER BY sum(sales.sales * weight.value) DESC, sales.package_id DESC
+            LIMIT :limit
+        """, {"weights": json.dumps(trending_weights()), "limit": max(limit, 0)})]
+    return db_get_packages_by_ids(package_ids, fields)
+
+
+@cached("package_by_id", PACKAGE_TABLES)
 def db_get_package_by_id(package_id: int) -> Package:
+    snapshot = catalog.current
+    if snapshot is not None:
+        return snapshot.packages.get(package_id)
     package = get_dataclass_by_id(package_id, "package", Package)
     if package is None:
         return None
-    with sqlite3.connect(DB_PATH) as conn:
+    with pool.connection() as conn:
         cur = conn.cursor()
         set_package_attachment(package, cur)
         return package
 
 
-def db_get_packages_by_country(country: str) -> List[Package]:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT * FROM 'package' where country=:country
+@cached("packages_by_ids", PACKAGE_TABLES)
+def db_get_packages_by_ids(
+    package_ids: List[int], fields: PackageFields = ALL_FIELDS) -> List[Package]:
+    '''packages in the order of `package_ids`, unknown ids are skipped'''
+    snapshot = catalog.current
+    if snapshot is not None:
+        return [snapshot.packages[i] for i in dict.fromkeys(package_ids) if i in snapshot.packages]
+    with pool.connection() as conn:
+        cur = model_cursor(conn, Package)
+        cur.execute(f"""
+            SELECT {fields.select()} FROM package WHERE id IN (SELECT value FROM json_each(:ids))
+        """, {"ids": json.dumps(package_ids)})
+        packages = {package.id: package for package in fetch_packages(cur, fields)}
+    return [packages[i] for i in dict.fromkeys(package_ids) if i in packages]
+
+
+@cached("packages_by_country", PACKAGE_TABLES)
+def db_get_packages_by_country(
+    country: str, fields: PackageFields = ALL_FIELDS) -> List[Package]:
+    snapshot = catalog.current
+    if snapshot is not None:
+        return snapshot.packages_by_country.get(country, [])
+    with pool.connection() as conn:
+        cur = model_cursor(conn, Package)
+        cur.execute(f"""
+            SELECT {fields.select()} FROM 'package' where country=:country
         """, {"country": country})
 
-        packages = []
-        for res in cur.fetchall():
-            obj = tuple_to_dataclass(res, Package)
-            set_package_attachment(obj, cur)
-            packages.append(obj)
-        return packages
+        return fetch_packages(cur, fields)
+
+
+def iter_packages_by_country(
+    country: str,
+    batch_size: int = STREAM_BATCH_SIZE,
+    fields: PackageFields = ALL_FIELDS) -> Iterator[Package]:
+    snapshot = catalog.current
+    if snapshot is not None:
+        return iter(snapshot.packages_by_country.get(country, []))
+    return iter_packages(f"""
+        SELECT {fields.select()} FROM 'package' where country=:country
+    """, {"country": country}, batch_size, fields)
+
+
+@cached("packages_by_destination", PACKAGE_TABLES)
+def db_get_packages_by_destination(
+    destination: str, fields: PackageFields = ALL_FIELDS) -> List[Package]:
+    snapshot = catalog.current
+    if snapshot is not None:
+        return snapshot.packages_by_destination.get(destination, [])
+    with pool.connection() as conn:
+        cur = model_cursor(conn, Package)
+        cur.execute(f"""
+            SELECT {fields.select()} FROM 'package' where destination=:destination
+        """, {"destination": destination})
 
+        return fetch_packages(cur, fields)
 
-def db_get_packages_by_destination(destination: str) -> List[Package]:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT * FROM 'package' where destination=:destination
-        """, {"destination": destination})
 
-        packages = []
-        for res in cur.fetchall():
-            obj = tuple_to_dataclass(res, Package)
-            set_package_attachment(obj, cur)
-            packages.append(obj)
-        return packages
+def iter_packages_by_destination(
+    destination: str,
+    batch_size: int = STREAM_BATCH_SIZE,
+    fields: PackageFields = ALL_FIELDS) -> Iterator[Package]:
+    snapshot = catalog.current
+    if snapshot is not None:
+        return iter(snapshot.packages_by_destination.get(destination, []))
+    return iter_packages(f"""
+        SELECT {fields.select()} FROM 'package' where destination=:destination
+    """, {"destination": destination}, batch_size, fields)
+
+
+def package_filters(
+    country: Optional[str] = None,
+    destination: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    min_duration: Optional[int] = None,
+    max_duration: Optional[int] = None,
+    price_column: str = "price",
+    duration_column: str = "duration") -> Tuple[str, Dict]:
+    '''WHERE clause and parameters of the given package filters'''
+    filters = [
+        ("country = :country", "country", country),
+        ("destination = :destination", "destination", destination),
+        (f"{price_column} >= :min_price", "min_price", min_price),
+        (f"{price_column} <= :max_price", "max_price", max_price),
+        (f"{duration_column} >= :min_duration", "min_duration", min_duration),
+        (f"{duration_column} <= :max_duration", "max_duration", max_duration),
+    ]
+    clauses = [clause for clause, _, value in filters if value is not None]
+    params = {name: value for _, name, value in filters if value is not None}
+    return " AND ".join(clauses) or "1", params
+
+
+@cached("package_query", PACKAGE_TABLES, maxsize=512)
+def db_query_packages(
+    country: Optional[str] = None,
+    destination: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    min_duration: Optional[int] = None,
+    max_duration: Optional[int] = None,
+    sort: str = "num_of_sales",
+    descending: bool = True,
+    limit: int = 20,
+    offset: int = 0,
+    price_bucket: float = 500,
+    fields: PackageFields = ALL_FIELDS) -> Tuple[List[Package], Dict]:
+    '''one page of the filtered packages, and facet counts of all of them.
+
+    The facets are computed in a single GROUP BY pass over the filtered
+    packages: {"total": n, "country": {country: n}, "price": [{"min", "max",
+    "count"}]}, price buckets being `price_bucket` wide. Raises ValueError
+    for an unknown sort key.
+    '''
+    if sort not in PACKAGE_SORTS:
+        raise ValueError(f"unknown sort key {sort!r}")
+    if price_bucket <= 0:
+        raise ValueError("price_bucket must be positive")
+    filters = (country, destination, min_price, max_price, min_duration, max_duration)
+    where, params = package_filters(*filters)
+    # unless sorting by them, "+price" and "+duration" keep the planner off the
+    # price and duration range indexes: walking an index in sort order stops
+    # after one page, while a range has to be read and sorted in full
+    page_where, _ = package_filters(
+        *filters,
+        price_column="price" if sort == "price" else "+price",
+        duration_column="duration" if sort == "duration" else "+duration")
+    direction = "DESC" if descending else "ASC"
+    with pool.connection() as conn:
+        cur = model_cursor(conn, Package)
+        cur.execute(f"""
+            SELECT {fields.select()} FROM package WHERE {page_where}
+            ORDER BY {PACKAGE_SORTS[sort]} {direction}, id {direction}
+            LIMIT :limit OFFSET :offset
+        """, {**params, "limit": max(limit, 0), "offset": max(offset, 0)})
+        packages = fetch_packages(cur, fields)
+        # unfiltered, the facets count every package: one pass over the covering
+        # idx_package_country_price, cached like the page
+        scan = "/* full scan: facets of every package */" if where == "1" else ""
+        groups = conn.execute(f"""
+            SELECT {scan} country, CAST(price / :price_bucket AS INTEGER), count(*)
+            FROM package WHERE {where}
+            GROUP BY 1, 2
+        """, {**params, "price_bucket": price_bucket}).fetchall()
+    countries: Dict[str, int] = {}
+    buckets: Dict[int, int] = {}
+    for group_country, bucket, count in groups:
+        countries[group_country] = countries.get(group_country, 0) + count
+        buckets[bucket] = buckets.get(bucket, 0) + count
+    facets = {
+        "total": sum(countries.values()),
+        "country": countries,
+        "price": [
+            {"min": bucket * price_bucket, "max": (bucket + 1) * price_bucket, "count": count}
+            for bucket, count in sorted(buckets.items())
+        ],
+    }
+    return packages, facets
+
+
+def fts_query(text: str, prefix: bool = True) -> Optional[str]:
+    '''FTS5 query matching every word of `text`, the last one as a prefix.
+
+    Words are quoted, so operators and punctuation typed by users are
+    searched for literally instead of being parsed as FTS5 syntax.
+    '''
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if prefix:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+@cached("package_search", PACKAGE_TABLES, maxsize=1024)
+def db_search_packages(
+    text: str,
+    limit: int = 10,
+    offset: int = 0,
+    prefix: bool = True,
+    fields: PackageFields = ALL_FIELDS) -> List[Package]:
+    '''packages matching `text`, best bm25 rank first'''
+    query = fts_query(text, prefix)
+    if query is None:
+        return []
+    with pool.connection() as conn:
+        cur = model_cursor(conn, Package)
+        cur.execute(f"""
+            SELECT {fields.select()} FROM package_fts
+            JOIN package ON package.id = package_fts.rowid
+            WHERE package_fts MATCH :query
+            ORDER BY bm25(package_fts, {", ".join(map(str, SEARCH_WEIGHTS))}), package.id
+            LIMIT :limit OFFSET :offset
+        """, {"query": query, "limit": max(limit, 0), "offset": max(offset, 0)})
+        return fetch_packages(cur, fields)
 
 
+@cached("hotels_by_destination", ["hotel"])
 def db_get_hotels_by_destination(destination: str) -> List[Hotel]:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
+    snapshot = catalog.current
+    if snapshot is not None:
+        return snapshot.hotels_by_destination.get(destination, [])
+    with pool.connection() as conn:
+        cur = model_cursor(conn, Hotel)
         cur.execute("""
             SELECT * FROM hotel WHERE destination=:destination 
         """, {"destination": destination})
-        hotels = []
-        for res in cur.fetchall():
-            hotel = tuple_to_dataclass(res, Hotel)
-            hotels.append(hotel)
-        return hotels
+        return cur.fetchall()
 
 
+@cached("restaurants_by_destination", ["restaurant"])
 def db_get_restaurants_by_destination(destination: str) -> List[Restaurant]:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
+    snapshot = catalog.current
+    if snapshot is not None:
+        return snapshot.restaurants_by_destination.get(destination, [])
+    with pool.connection() as conn:
+        cur = model_cursor(conn, Restaurant)
         cur.execute("""
             SELECT * FROM restaurant WHERE destination=:destination 
         """, {"destination": destination})
-        restaurants = []
-        for res in cur.fetchall():
-            restaurant = tuple_to_dataclass(res, Restaurant)
-            restaurants.append(restaurant)
-        return restaurants
+        return cur.fetchall()
 
 
 def db_get_hotel_by_destination(destination: str) -> List[Hotel]:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
+    with pool.connection() as conn:
+        cur = model_cursor(conn, Hotel)
         cur.execute("""
             SELECT * FROM hotel WHERE destination=:destination 
         """, {"destination": destination})
-        hotels = []
-        for res in cur.fetchall():
-            hotel = tuple_to_dataclass(res, Hotel)
-            hotels.append(hotel)
-        return hotels
+        return cur.fetchall()
+
+
+def db_sample_available(
+    conn: sqlite3.Connection,
+    table: str,
+    model: type,
+    undesired_ids: List[int] = [],
+    where: str = "1",
+    params: Dict = {},
+    probes: int = 8) -> BaseModel:
+    '''pick a uniformly random row of `table` matching `where` whose id is not undesired.
+
+    First probe a few random ids between the smallest and largest candidate
+    id, each probe being a primary key lookup. When candidates are too
+    sparse for that, count them over the index and jump to a random offset.
+    Only the chosen row is turned into a model.
+    '''
+    params = dict(params, undesired=json.dumps(undesired_ids))
+    candidates = f"""
+        {where} AND id NOT IN (SELECT value FROM json_each(:undesired))
+    """
+    # one scalar subquery per bound: each walks the id order from one end and
+    # stops at the first candidate, where min(id), max(id) together scan
+    low, high = conn.execute(f"""
+        SELECT
+            (SELECT id FROM {table} WHERE {candidates} ORDER BY id LIMIT 1),
+            (SELECT id FROM {table} WHERE {candidates} ORDER BY id DESC LIMIT 1)
+    """, params).fetchone()
+    if low is None:
+        return None
+    cur = model_cursor(conn, model)
+    # random simpling here to simulate real production schedualing
+    for _ in range(probes):
+        params["pivot"] = random.randint(low, high)
+        cur.execute(f"""
+            SELECT * FROM {table} WHERE id=:pivot AND {candidates}
+        """, params)
+        res = cur.fetchone()
+        if res:
+            return res
+    count = conn.execute(f"""
+        SELECT count(*) FROM {table} WHERE {candidates}
+    """, params).fetchone()[0]
+    params["offset"] = random.randrange(count)
+    cur.execute(f"""
+        SELECT * FROM {table} WHERE {candidates}
+        ORDER BY id LIMIT 1 OFFSET :offset
+    """, params)
+    return cur.fetchone()
 
 
 def get_available_guide(undesired_guide_ids: List[int]) -> Guide:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM guide")
-        guides = []
-        for res in cur.fetchall():
-            guide = tuple_to_dataclass(res, Guide)
-            if guide.id not in undesired_guide_ids:
-                guides.append(guide)
-
-        if len(guides) == 0:
-            return None
-        
-        return random.sample(guides, 1)[0] # random simpling here to simulate real production schedualing
+    snapshot = catalog.current
+    if snapshot is not None:
+        return sample_available(snapshot.guide_list, undesired_guide_ids)
+    with pool.connection() as conn:
+        return db_sample_available(conn, "guide", Guide, undesired_guide_ids)
 
 
 def get_available_hotel(
     destination: str,
     undesired_hotel_ids: List[int] = []) -> Hotel:
-    hotels = db_get_hotels_by_destination(destination)
-    hotels = [
-        hotel for hotel in hotels \
-            if hotel.id not in undesired_hotel_ids
-    ]
-    if len(hotels) == 0:
-        return None
-    return random.sample(hotels, 1)[0] # random simpling here to simulate real production schedualing
+    snapshot = catalog.current
+    if snapshot is not None:
+        return sample_available(
+            snapshot.hotels_by_destination.get(destination, []), undesired_hotel_ids)
+    with pool.connection() as conn:
+        return db_sample_available(
+            conn, "hotel", Hotel, undesired_hotel_ids,
+            "destination=:destination", {"destination": destination})
+
+
+@cached("restaurant_index", ["restaurant"], maxsize=256)
+def db_get_restaurant_index(destination: str) -> Tuple[GridIndex, Dict[str, Restaurant]]:
+    '''spatial index of the restaurants of `destination`, and the restaurants by name'''
+    restaurants = db_get_restaurants_by_destination(destination)
+    return (
+        GridIndex(restaurants, lambda r: (r.latitude, r.longitude)),
+        {restaurant.name: restaurant for restaurant in restaurants},
+    )
+
+
+def get_nearest_restaurants(
+    destination: str,
+    k: int = 5,
+    latitude: Optional[float] = None,
+    longitude: Optional[float] = None,
+    hotel_id: Optional[int] = None,
+    old_restaurant_name: Optional[str] = None) -> Optional[List[Tuple[float, Restaurant]]]:
+    '''k nearest (distance in km, restaurant) of `destination`, nearest first.
+
+    Distances are measured from latitude/longitude if given, else from the
+    hotel, else from the old restaurant, which is never returned itself.
+    Returns None if none of them has coordinates.
+    '''
+    index, by_name = db_get_restaurant_index(destination)
+    if latitude is None or longitude is None:
+        origin = None
+        if hotel_id is not None:
+            origin = db_get_hotel_by_id(hotel_id)
+        if (origin is None or origin.latitude is None) and old_restaurant_name is not None:
+            origin = by_name.get(old_restaurant_name)
+        if origin is None or origin.latitude is None or origin.longitude is None:
+            return None
+        latitude, longitude = origin.latitude, origin.longitude
+    return index.nearest(
+        latitude, longitude, k, exclude=lambda r: r.name == old_restaurant_name)
 
 
 def get_nearest_restaurant(
     destination: str, 
     old_restaurant_name: str) -> Restaurant:
-
-    restaurants = db_get_restaurants_by_destination(destination)
-    restaurants = [
-        restaurant for restaurant in restaurants \
+    '''the restaurant nearest to the old one, or a random other one without coordinates'''
+    nearest = get_nearest_restaurants(
+        destination, 1, old_restaurant_name=old_restaurant_name)
+    if nearest:
+        return nearest[0][1]
+    snapshot = catalog.current
+    if snapshot is not None:
+        return sample_available([
+            restaurant for restaurant in snapshot.restaurants_by_destination.get(destination, [])
             if restaurant.name != old_restaurant_name
-    ]
-    if len(restaurants) == 0:
-        return None
-    return random.sample(restaurants, 1)[0] # random simpling here to simulate real production schedualing
+        ], [])
+    with pool.connection() as conn:
+        return db_sample_available(
+            conn, "restaurant", Restaurant,
+            where="destination=:destination AND name!=:old_restaurant_name",
+            params={
+                "destination": destination,
+                "old_restaurant_name": old_restaurant_name
+            })
 
 
 def create_user(username: str, password: str) -> User:
@@ -235,180 +653,381 @@ def create_user(username: str, password: str) -> User:
         "name": username
     })
     u.generate_password_key(password)
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            insert into user (name, password_key, salt) 
-            values (:name, :password_key, :salt)
-        """, {"name": u.name, "password_key":u.password_key, "salt": u.salt})
-        conn.commit()
+    return insert_user(u)
+
+
+def insert_user(u: User) -> User:
+    '''store a user whose password key has already been derived'''
+    def job(conn: sqlite3.Connection) -> User:
+        conn.execute("""
+            insert into user (name, password_key, salt, hash_version) 
+            values (:name, :password_key, :salt, :hash_version)
+        """, {
+            "name": u.name,
+            "password_key": u.password_key,
+            "salt": u.salt,
+            "hash_version": u.hash_version
+        })
         return u
 
+    writer.submit(job)
+    usernames.add(u.name)
+    return u
+
+
+def update_user_password_key(u: User) -> None:
+    '''persist a rehashed password key, e.g. after a hash version upgrade'''
+    def job(conn: sqlite3.Connection) -> None:
+        conn.execute("""
+            UPDATE user SET password_key=:password_key, salt=:salt, 
+                hash_version=:hash_version
+            WHERE name=:name
+        """, {
+            "name": u.name,
+            "password_key": u.password_key,
+            "salt": u.salt,
+            "hash_version": u.hash_version
+        })
+
+    writer.submit(job)
+
 
 def get_user_by_name(username: str) -> User:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor() 
+    with pool.connection() as conn:
+        cur = model_cursor(conn, User)
         cur.execute("""
             SELECT * FROM user WHERE name=:username
         """, {"username": username})
-        res = cur.fetchone()
-        user = tuple_to_dataclass(res, User)
-        return user
+        return cur.fetchone()
+
+
+def user_exists(username: str) -> bool:
+    '''answered from the username index, without building a User.
+
+    With the writer thread running, the index is marked stale whenever
+    another process commits, so a fresh index answers both ways. Without
+    it nothing reports users registered by other workers: a name missing
+    from the index is then confirmed by a query.
+    '''
+    if USERNAME_INDEX_ENABLED:
+        if not usernames.fresh():
+            with pool.connection() as conn:
+                usernames.refresh(conn)
+        if username in usernames:
+            return True
+        if writer.running():
+            return False
+    with pool.connection() as conn:
+        exists = conn.execute(
+            "SELECT 1 FROM user WHERE name=:username LIMIT 1",
+            {"username": username}).fetchone() is not None
+    if exists and USERNAME_INDEX_ENABLED:
+        usernames.add(username)
+    return exists
+
+
+def load_usernames() -> None:
+    if USERNAME_INDEX_ENABLED:
+        with pool.connection() as conn:
+            usernames.refresh(conn)
 
 
 def validate_user_password(username: str, target_password: str) -> bool:
+    if not user_exists(username):
+        return False
     user = get_user_by_name(username)
+    if user is None:
+        return False
     return user.validate_key(target_password)
 
 
+def sales_of(conn: sqlite3.Connection, package_ids: List[int]) -> Dict[int, int]:
+    '''num_of_sales of the packages, as the order triggers left them'''
+    if not package_ids:
+        return {}
+    return dict(conn.execute("""
+        SELECT id, num_of_sales FROM package WHERE id IN (SELECT value FROM json_each(:ids))
+    """, {"ids": json.dumps(sorted(set(package_ids)))}).fetchall())
+
+
+def orders_written(usernames: List[str], sales: Dict[int, int]) -> None:
+    '''after_commit of order writes: pass the new counts to the ranking, in
+    commit order, then drop the cached orders of `usernames` and the popular
+    and trending packages. Other package caches keep the old num_of_sales
+    until their TTL runs out.'''
+    for package_id, num_of_sales in sales.items():
+        ranking.update(package_id, num_of_sales)
+    invalidate_users(*usernames)
+    if sales:
+        invalidate("sales")
+
+
 def create_order(username: str, package_id: int) -> Order:
     package = db_get_package_by_id(package_id)
     flight = get_available_flight()
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor() 
-        cur.execute("""
+    order = Order(
+        username=username, 
+        package_id=package_id,
+        guide_id=package.guide_id,
+        hotel_id=package.hotel_id,
+        flight_id=flight.id)
+
+    def job(conn: sqlite3.Connection) -> Dict[int, int]:
+        conn.execute("""
             insert into 'order' (username, package_id, guide_id, hotel_id, flight_id) 
             values (:username, :package_id, :guide_id, :hotel_id, :flight_id)
-        """, {
-            "username": username, 
-            "package_id":package_id,
-            "guide_id": package.guide_id,
-            "hotel_id": package.hotel_id,
-            "flight_id": flight.id
-        })
-        conn.commit()
-        return Order(
-            username=username, 
-            package_id=package_id,
-            guide_id=package.guide_id,
-            hotel_id=package.hotel_id,
-            flight_id=flight.id)
+        """, order.dict())
+        return sales_of(conn, [package_id])
+
+    writer.submit(job, lambda sales: orders_written([username], sales))
+    return order
+
+
+def create_orders(items: List[Tuple[str, int]]) -> List[Tuple[str, Optional[Order]]]:
+    '''create many (username, package_id) orders in one transaction.
+
+    Packages and the flight are resolved with one set-based query each and
+    all new orders are inserted with a single executemany in one write
+    transaction. Returns
+    one (status, order) pair per item, status being "created", "duplicate",
+    "package_not_found" or "no_flight_available".
+    '''
+    package_ids = json.dumps(sorted({package_id for _, package_id in items}))
+    pairs = json.dumps([[username, package_id] for username, package_id in items])
+    with pool.connection() as conn:
+        packages = {
+            row[0]: row[1:] for row in conn.execute("""
+                SELECT id, guide_id, hotel_id FROM package
+                WHERE id IN (SELECT value FROM json_each(:ids))
+            """, {"ids": package_ids})
+        }
+    flight = get_available_flight()
+
+    # in a write transaction: nobody can insert between the duplicate check and our insert
+    def job(conn: sqlite3.Connection) -> Tuple[List[Tuple[str, Optional[Order]]], Dict[int, int]]:
+        existing = set(conn.execute("""
+            SELECT username, package_id FROM 'order'
+            WHERE (username, package_id) IN (
+                SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]')
+                FROM json_each(:pairs))
+        """, {"pairs": pairs}).fetchall())
+        results = []
+        for username, package_id in items:
+            if package_id not in packages:
+                results.append(("package_not_found", None))
+            elif flight is None:
+                results.append(("no_flight_available", None))
+            elif (username, package_id) in existing:
+                results.append(("duplicate", None))
+            else:
+                existing.add((username, package_id))
+                guide_id, hotel_id = packages[package_id]
+                results.append(("created", Order(
+                    username=username,
+                    package_id=package_id,
+                    guide_id=guide_id,
+                    hotel_id=hotel_id,
+                    flight_id=flight.id)))
+        conn.executemany("""
+            insert into 'order' (username, package_id, guide_id, hotel_id, flight_id) 
+            values (:username, :package_id, :guide_id, :hotel_id, :flight_id)
+        """, [order.dict() for status, order in results if status == "created"])
+        return results, sales_of(
+            conn, [order.package_id for status, order in results if status == "created"])
+
+    def after_commit(result) -> None:
+        results, sales = result
+        orders_written(
+            [order.username for status, order in results if status == "created"], sales)
+
+    results, _ = writer.submit(job, after_commit)
+    return results
 
 
+@cached(
+    "packages_by_username", ("order",) + PACKAGE_TABLES, maxsize=1024, user_of=first_argument)
 def get_packages_by_username(username: str) -> List[Package]:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor() 
+    with pool.connection() as conn:
+        cur = model_cursor(conn, Package)
         cur.execute("""
             SELECT 'package'.*
             FROM 'order' JOIN 'package' ON 'order'.package_id='package'.id
             WHERE 'order'.username=:username
         """, {"username": username})
-        packages = []
-        for res in cur.fetchall():
-            obj = tuple_to_dataclass(res, Package)
-            set_package_attachment(obj, cur)
-            packages.append(obj)
-        return packages
+        return fetch_packages(cur)
+
+
+def iter_packages_by_username(
+    username: str, batch_size: int = STREAM_BATCH_SIZE) -> Iterator[Package]:
+    return iter_packages("""
+        SELECT 'package'.*
+        FROM 'order' JOIN 'package' ON 'order'.package_id='package'.id
+        WHERE 'order'.username=:username
+    """, {"username": username}, batch_size)
+
+
+itinerary_rows = JoinMapper(Package, Hotel, Guide, Flight, CarRental)
+
+
+@cached(
+    "itinerary", ("order", "flight") + PACKAGE_TABLES, maxsize=4096, user_of=first_argument)
+def get_itinerary(username: str) -> List[Itinerary]:
+    '''the orders of a user with what they booked, in one query'''
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.row_factory = itinerary_rows
+        cur.execute(f"""
+            SELECT {itinerary_rows.select("p", "h", "g", "f", "c")}
+            FROM 'order' AS o
+            JOIN package AS p ON p.id = o.package_id
+            LEFT JOIN hotel AS h ON h.id = o.hotel_id
+            LEFT JOIN guide AS g ON g.id = o.guide_id
+            LEFT JOIN flight AS f ON f.id = o.flight_id
+            LEFT JOIN car_rental AS c ON c.id = p.car_rental_id
+            WHERE o.username = :username
+            ORDER BY o.package_id
+        """, {"username": username})
+        return [
+            Itinerary.construct(
+                package=package, hotel=hotel, guide=guide, flight=flight, car_rental=car_rental)
+            for package, hotel, guide, flight, car_rental in cur
+        ]
 
 
 def delete_order(username: str, package_id: int) -> int:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor() 
-        cur.execute("""
+    def job(conn: sqlite3.Connection) -> Tuple[int, Dict[int, int]]:
+        rows_affected = conn.execute("""
             DELETE FROM 'order' 
             WHERE username=:username and package_id=:package_id
-        """, {'username': username, 'package_id': package_id})
-        rows_affected = cur.rowcount
-        conn.commit()
-        return rows_affected
+        """, {'username': username, 'package_id': package_id}).rowcount
+        return rows_affected, sales_of(conn, [package_id] if rows_affected else [])
+
+    rows_affected, _ = writer.submit(
+        job, lambda result: orders_written([username] if result[0] else [], result[1]))
+    return rows_affected
 
 
 def get_available_flight(undesired_flight_ids: List[int]=[]) -> Flight:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor() 
-        cur.execute("SELECT * FROM flight")
-        flights = []
-        for res in cur.fetchall():
-            flight = tuple_to_dataclass(res, Flight)
-            if flight.id not in undesired_flight_ids:
-                flights.append(flight)
-        return flights[0] if len(flights) != 0 else None
+    snapshot = catalog.current
+    if snapshot is not None:
+        undesired = set(undesired_flight_ids)
+        return next((f for f in snapshot.flight_list if f.id not in undesired), None)
+    with pool.connection() as conn:
+        cur = model_cursor(conn, Flight)
+        cur.execute("""
+            SELECT * FROM flight
+            WHERE id NOT IN (SELECT value FROM json_each(:undesired))
+            ORDER BY id LIMIT 1
+        """, {"undesired": json.dumps(undesired_flight_ids)})
+        return cur.fetchone()
 
 
 def get_user(username: str) -> User:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor() 
+    with pool.connection() as conn:
+        cur = model_cursor(conn, User)
         cur.execute("SELECT * FROM user WHERE name=:username", 
             {'username': username})
-        res = cur.fetchone()
-        if res:
-            return tuple_to_dataclass(res, User)
-        else:
-            return None
+        return cur.fetchone()
+
+
+@cached("package_ids_by_destination", ["package"], maxsize=1)
+def db_get_package_ids_by_destination() -> Dict[str, int]:
+    '''destination -> id of its first package, loaded in one query'''
+    snapshot = catalog.current
+    if snapshot is not None:
+        return snapshot.package_ids_by_destination
+    with pool.connection() as conn:
+        return dict(conn.execute("""
+            SELECT /* full scan: one row per destination */ destination, min(id)
+            FROM package GROUP BY destination
+        """).fetchall())
 
 
 def get_package_id_by_destination(destination: str) -> int:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor() 
-        cur.execute("SELECT id FROM package WHERE destination=:destination", 
-            {'destination': destination})
-        res = cur.fetchone()
-        if res:
-            return res[0]
-        else:
-            return None
+    return db_get_package_ids_by_destination().get(destination)
 
 
 def get_user_order(username: str, destination: str) -> Order:
     package_id = get_package_id_by_destination(destination)
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor() 
+    with pool.connection() as conn:
+        cur = model_cursor(conn, Order)
         cur.execute("""
-            SELECT 'order'.*
-            FROM 'order' JOIN 'package' ON 'order'.package_id='package'.id
-            WHERE 'order'.username=:username AND 'order'.package_id=:package_id;
+            SELECT * FROM 'order'
+            WHERE username=:username AND package_id=:package_id
         """, {'username': username, 'package_id': package_id})
-        res = cur.fetchone()
-        if res:
-            return tuple_to_dataclass(res, Order)
-        else:
-            return None
+        return cur.fetchone()
+
+
+def modify_user_order(
+    username: str,
+    package_id: int,
+    change_guide: bool = False,
+    new_hotel_id: Optional[int] = None,
+    new_flight_id: Optional[int] = None) -> Optional[Dict[str, BaseModel]]:
+    '''change guide, hotel and/or flight of an order in one transaction.
+
+    The order is updated with a single UPDATE ... RETURNING and committed
+    once. Returns the new attachments keyed by "guide", "hotel" and "flight"
+    (only the changed ones), or None if the user has no such order.
+    '''
+    params = {
+        'username': username,
+        'package_id': package_id,
+        'new_guide_id': None,
+        'new_hotel_id': new_hotel_id,
+        'new_flight_id': new_flight_id,
+    }
+
+    def job(conn: sqlite3.Connection) -> Tuple[bool, Optional[Guide]]:
+        new_guide = None
+        if change_guide:
+            res = conn.execute("""
+                SELECT guide_id FROM 'order'
+                WHERE username=:username AND package_id=:package_id
+            """, params).fetchone()
+            if res is None:
+                return False, None
+            new_guide = db_sample_available(conn, "guide", Guide, [res[0]])
+            params['new_guide_id'] = new_guide.id if new_guide else None
+        updated = conn.execute("""
+            UPDATE 'order' SET
+                guide_id=coalesce(:new_guide_id, guide_id),
+                hotel_id=coalesce(:new_hotel_id, hotel_id),
+                flight_id=coalesce(:new_flight_id, flight_id)
+            WHERE username=:username AND package_id=:package_id
+            RETURNING guide_id
+        """, params).fetchall()
+        return len(updated) > 0, new_guide
+
+    updated, new_guide = writer.submit(job)
+    if not updated:
+        return None
+    invalidate_users(username)
+    changes = {}
+    if change_guide:
+        changes['guide'] = new_guide
+    if new_hotel_id is not None:
+        changes['hotel'] = db_get_hotel_by_id(new_hotel_id)
+    if new_flight_id is not None:
+        changes['flight'] = db_get_flight_by_id(new_flight_id)
+    return changes
 
 
 def change_user_guide(order: Order) -> Guide:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor() 
-        new_guide = get_available_guide([order.guide_id])
-        cur.execute("""
-            UPDATE 'order' SET guide_id=:new_guide_id 
-            WHERE username=:username AND package_id=:package_id 
-        """, {
-            'new_guide_id': new_guide.id, 
-            'username': order.username, 
-            'package_id': order.package_id
-        })
-        conn.commit()
-        return new_guide
+    changes = modify_user_order(order.username, order.package_id, change_guide=True)
+    return changes['guide'] if changes else None
 
 
 def change_user_hotel(order: Order, new_hotel_id: int) -> Hotel:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor() 
-        cur.execute("""
-            UPDATE 'order' SET hotel_id=:new_hotel_id 
-            WHERE username=:username AND package_id=:package_id 
-        """, {
-            'new_hotel_id': new_hotel_id, 
-            'username': order.username, 
-            'package_id': order.package_id
-        })
-        conn.commit()
-        return db_get_hotel_by_id(new_hotel_id)
+    changes = modify_user_order(
+        order.username, order.package_id, new_hotel_id=new_hotel_id)
+    return changes['hotel'] if changes else None
 
 
 def change_user_flight(order: Order, new_flight_id: int) -> Flight:
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor() 
-        cur.execute("""
-            UPDATE 'order' SET flight_id=:new_flight_id 
-            WHERE username=:username AND package_id=:package_id 
-        """, {
-            'new_flight_id': new_flight_id, 
-            'username': order.username, 
-            'package_id': order.package_id
-        })
-        conn.commit()
-        return db_get_flight_by_id(new_flight_id)
+    changes = modify_user_order(
+        order.username, order.package_id, new_flight_id=new_flight_id)
+    return changes['flight'] if changes else None
 
 
 if __name__ == "__main__":
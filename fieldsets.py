@@ -0,0 +1,85 @@
+'''Sparse fieldsets for package listings.
+
+`?fields=id,title,pic_url` picks the package columns a listing returns, and
+`?expand=hotel,guide` the attachments loaded with them. Only those columns
+are selected, and only the listed attachment tables are queried. Without
+`fields`, every column and every attachment is returned as before. With
+`fields`, attachments are only loaded when listed in `expand`.
+
+db_utils builds the packages from the selected columns. The route then
+projects them with `PackageFields.project`, which drops the columns that
+were only read for keys, cursors or attachments.
+'''
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from data import Attachment, Package
+
+ATTACHMENTS = tuple(attachment.name for attachment in Attachment)
+PACKAGE_COLUMNS = tuple(name for name in Package.__fields__ if name not in ATTACHMENTS)
+
+
+class InvalidFields(ValueError):
+    pass
+
+
+class PackageFields(NamedTuple):
+    # None: every column
+    columns: Optional[Tuple[str, ...]] = None
+    expand: Tuple[str, ...] = ATTACHMENTS
+
+    def full(self) -> bool:
+        return self.columns is None and set(self.expand) == set(ATTACHMENTS)
+
+    def attachments(self) -> List[Attachment]:
+        return [Attachment[name] for name in self.expand]
+
+    def select(self, table: str = "package", extra: Tuple[str, ...] = ()) -> str:
+        '''select list of the columns, plus `extra` and the keys the attachments need'''
+        if self.columns is None:
+            return f"{table}.*"
+        keys = tuple(name + "_id" for name in self.expand)
+        return ", ".join(
+            f"{table}.{column}" for column in dict.fromkeys(("id",) + self.columns + extra + keys))
+
+    def project(self, package: Package) -> Dict:
+        return package.dict(include=set(self.columns or PACKAGE_COLUMNS) | set(self.expand))
+
+
+ALL_FIELDS = PackageFields()
+
+
+def _names(value: str) -> Tuple[str, ...]:
+    return tuple(dict.fromkeys(name.strip() for name in value.split(",") if name.strip()))
+
+
+def parse_package_fields(fields: Optional[str], expand: Optional[str]) -> PackageFields:
+    '''fieldset of the `fields` and `expand` query parameters, raise InvalidFields on unknown names'''
+    columns = None if fields is None else _names(fields)
+    if expand is not None:
+        attachments = _names(expand)
+    else:
+        attachments = ATTACHMENTS if columns is None else ()
+    for name in columns or ():
+        if name not in PACKAGE_COLUMNS:
+            raise InvalidFields(f"unknown package field {name!r}")
+    for name in attachments:
+        if name not in ATTACHMENTS:
+            raise InvalidFields(f"unknown attachment {name!r}")
+    if columns == ():
+        raise InvalidFields("fields must name at least one package field")
+    # in declaration order: ?fields=title,id and ?fields=id,title select the
+    # same columns and must share cache keys and query metric labels
+    if columns is not None:
+        columns = tuple(name for name in PACKAGE_COLUMNS if name in columns)
+    attachments = tuple(name for name in ATTACHMENTS if name in attachments)
+    return PackageFields(columns, attachments)
+
+
+def project_packages(packages: Iterable[Package], fields: PackageFields) -> Iterable:
+    '''packages as a route returns them: untouched for the full fieldset,
+    projected dicts otherwise, lazily if `packages` is not a list (streams)'''
+    if fields.full():
+        return packages
+    if isinstance(packages, list):
+        return [fields.project(package) for package in packages]
+    return (fields.project(package) for package in packages)
@@ -0,0 +1,29 @@
+# Multi-process serving: gunicorn -c gunicorn.conf.py main:app
+#
+# Every worker is a uvicorn event loop with its own connection pool, caches
+# and write coordinator. Reads scale across workers. Writes are grouped per
+# worker by the coordinator and serialized between workers by SQLite's write
+# lock, which in WAL mode never blocks readers.
+import multiprocessing
+import os
+import secrets
+
+bind = os.environ.get("TRIPPY_BIND", "0.0.0.0:8082")
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.get("TRIPPY_WORKERS", min(multiprocessing.cpu_count() * 2, 8)))
+# load the app in each worker: connections and threads must not cross a fork
+preload_app = False
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+accesslog = os.environ.get("TRIPPY_ACCESS_LOG")
+
+
+def on_starting(server):
+    # runs in the master before any fork: every worker inherits the same
+    # session secret, so a token issued by one worker validates on all
+    if not os.environ.get("TRIPPY_SESSION_SECRET"):
+        os.environ["TRIPPY_SESSION_SECRET"] = secrets.token_hex(32)
+        server.log.warning(
+            "TRIPPY_SESSION_SECRET is not set, generated one for this server: "
+            "session tokens will not survive a restart")
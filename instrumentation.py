@@ -0,0 +1,225 @@
+'''Per-query and per-route timing, exposed in Prometheus text format.
+
+Pooled connections are created with InstrumentedConnection, whose cursors
+time every execute and count the rows fetched or changed. The HTTP
+middleware in main.py times every route and counts the queries each request
+ran, so N+1 patterns show up as a high queries-per-request ratio. Queries
+slower than TRIPPY_SLOW_QUERY_MS are logged on the "trippy.sql" logger.
+'''
+import contextvars
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("trippy.sql")
+
+SLOW_QUERY_MS: Optional[float] = (
+    float(os.environ["TRIPPY_SLOW_QUERY_MS"])
+    if os.environ.get("TRIPPY_SLOW_QUERY_MS") else None)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class RequestStats:
+    '''queries run on behalf of the current HTTP request'''
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.query_seconds = 0.0
+
+
+current_request: contextvars.ContextVar[Optional[RequestStats]] = \
+    contextvars.ContextVar("current_request", default=None)
+
+
+class _Aggregate:
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+
+_lock = threading.Lock()
+_queries: Dict[str, _Aggregate] = {}
+_routes: Dict[Tuple[str, str, int], _Aggregate] = {}
+# (method, route) -> [queries, seconds spent in queries]
+_route_queries: Dict[Tuple[str, str], List[float]] = {}
+
+# called with (sql, parameters) before every instrumented execute
+_statement_listeners: List[Callable[[str, Any], None]] = []
+
+_PLACEHOLDER_LIST = re.compile(r"\?(\s*,\s*\?)+")
+
+
+def normalize_sql(sql: str) -> str:
+    '''one label per statement shape: collapse whitespace and IN (?, ?, ...) lists'''
+    return _PLACEHOLDER_LIST.sub("?, ...", " ".join(sql.split()))
+
+
+def record_query(statement: str, seconds: float, rows: int) -> None:
+    '''record one execute of an already normalized statement'''
+    with _lock:
+        aggregate = _queries.get(statement)
+        if aggregate is None:
+            aggregate = _queries[statement] = _Aggregate()
+        aggregate.observe(seconds)
+        aggregate.rows += rows
+    request = current_request.get()
+    if request is not None:
+        request.queries += 1
+        request.query_seconds += seconds
+    if SLOW_QUERY_MS is not None and seconds * 1000 >= SLOW_QUERY_MS:
+        logger.warning("slow query %.1fms rows=%d: %s", seconds * 1000, rows, statement)
+
+
+def add_statement_listener(listener: Callable[[str, Any], None]) -> None:
+    '''call `listener(sql, parameters)` before every statement an instrumented
+    cursor runs; executemany passes its first parameter set'''
+    _statement_listeners.append(listener)
+
+
+def _record_rows(statement: str, rows: int) -> None:
+    with _lock:
+        aggregate = _queries.get(statement)
+        if aggregate is not None:
+            aggregate.rows += rows
+
+
+def record_request(
+    method: str, route: str, status: int, seconds: float, request: RequestStats) -> None:
+    with _lock:
+        aggregate = _routes.get((method, route, status))
+        if aggregate is None:
+            aggregate = _routes[(method, route, status)] = _Aggregate()
+        aggregate.observe(seconds)
+        queries = _route_queries.setdefault((method, route), [0, 0.0])
+        queries[0] += request.queries
+        queries[1] += request.query_seconds
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+
+    _statement: Optional[str] = None
+
+    def execute(self, sql, parameters=()):
+        for listener in _statement_listeners:
+            listener(sql, parameters)
+        self._statement = normalize_sql(sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            # rowcount is -1 for SELECT, its rows are counted when fetched
+            record_query(self._statement, time.perf_counter() - started, max(self.rowcount, 0))
+
+    def executemany(self, sql, seq_of_parameters):
+        if _statement_listeners:
+            seq_of_parameters = list(seq_of_parameters)
+            for listener in _statement_listeners:
+                listener(sql, seq_of_parameters[0] if seq_of_parameters else ())
+        self._statement = normalize_sql(sql)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(self._statement, time.perf_counter() - started, max(self.rowcount, 0))
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None and self._statement is not None:
+            _record_rows(self._statement, 1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if rows and self._statement is not None:
+            _record_rows(self._statement, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if rows and self._statement is not None:
+            _record_rows(self._statement, len(rows))
+        return rows
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    '''sqlite3 connection whose cursors, including conn.execute, are instrumented'''
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items())
+
+
+def _histogram(lines: List[str], name: str, labels: Dict, aggregate: _Aggregate) -> None:
+    for bound, count in zip(LATENCY_BUCKETS, aggregate.buckets):
+        lines.append(f'{name}_bucket{{{_labels(**labels, le=bound)}}} {count}')
+    lines.append(f'{name}_bucket{{{_labels(**labels, le="+Inf")}}} {aggregate.count}')
+    lines.append(f'{name}_sum{{{_labels(**labels)}}} {aggregate.seconds}')
+    lines.append(f'{name}_count{{{_labels(**labels)}}} {aggregate.count}')
+
+
+def render_metrics(counters: List[Tuple[str, Dict[str, str], float]] = []) -> str:
+    '''all aggregates, plus extra (name, labels, value) counters, as Prometheus text'''
+    with _lock:
+        routes = list(_routes.items())
+        route_queries = [(key, list(value)) for key, value in _route_queries.items()]
+        queries = list(_queries.items())
+    lines = ["# TYPE trippy_http_request_duration_seconds histogram"]
+    for (method, route, status), aggregate in routes:
+        _histogram(lines, "trippy_http_request_duration_seconds",
+                   {"method": method, "route": route, "status": status}, aggregate)
+    lines.append("# TYPE trippy_http_request_queries_total counter")
+    for (method, route), (count, _) in route_queries:
+        lines.append(f'trippy_http_request_queries_total{{{_labels(method=method, route=route)}}} '
+                     f'{count}')
+    lines.append("# TYPE trippy_http_request_query_seconds_total counter")
+    for (method, route), (_, seconds) in route_queries:
+        lines.append(f'trippy_http_request_query_seconds_total{{{_labels(method=method, route=route)}}} '
+                     f'{seconds}')
+    lines.append("# TYPE trippy_db_query_duration_seconds histogram")
+    for statement, aggregate in queries:
+        _histogram(lines, "trippy_db_query_duration_seconds",
+                   {"statement": statement}, aggregate)
+    lines.append("# TYPE trippy_db_query_rows_total counter")
+    for statement, aggregate in queries:
+        lines.append(f'trippy_db_query_rows_total{{{_labels(statement=statement)}}} {aggregate.rows}')
+    declared = set()
+    for name, labels, value in counters:
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{{{_labels(**labels)}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    with _lock:
+        _queries.clear()
+        _routes.clear()
+        _route_queries.clear()
@@ -1,31 +1,150 @@
 import sqlite3
+import time
+from contextlib import asynccontextmanager
 from typing import List, Optional
-from fastapi import FastAPI, status, Response, Query
+from fastapi import Depends, FastAPI, Header, Request, status, Response, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic.main import BaseModel
-from db_utils import (
+from async_db import (
     db_get_info, 
-    db_get_popular_packages, 
+    db_get_popular_packages_page,
+    db_get_trending_packages,
     db_get_packages_by_country,
     get_available_guide,
     get_nearest_restaurant,
-    create_user,
+    get_nearest_restaurants,
+    insert_user,
+    update_user_password_key,
     get_packages_by_username,
+    get_itinerary,
     create_order,
+    create_orders,
+    db_get_packages_by_ids,
     delete_order,
-    validate_user_password,
     db_get_packages_by_destination,
+    db_search_packages,
+    db_query_packages,
     get_available_hotel,
     get_available_flight,
     get_user,
-    get_user_order,
-    change_user_guide,
-    change_user_hotel,
-    change_user_flight,
+    user_exists,
+    modify_user_order,
     get_package_id_by_destination,
 )
+import async_db
+from db_utils import (
+    DB_PATH, PACKAGE_SORTS, PACKAGE_TABLES, decode_popular_cursor, iter_packages_by_country,
+    iter_packages_by_destination, iter_packages_by_username, load_usernames, pool, writer)
+from cache import cache_stats, invalidate
+from catalog import CATALOG_TABLES, SNAPSHOT_ENABLED, catalog
 from data import Order
+from fieldsets import InvalidFields, PackageFields, parse_package_fields, project_packages
+import instrumentation
+from migrations import apply_migrations
+from password_hashing import PasswordHasherBusy, password_hasher
+from write_coordinator import COORDINATOR_ENABLED
+from response_cache import ResponseCache
+from sessions import SESSION_TTL, InvalidSession, bearer_username, issue_token
+from streaming import STREAM_FORMAT_PATTERN, stream_response
+
+
+
+# cached catalog reads must not outlive the snapshot they were built from
+catalog.on_swap(lambda: invalidate(*CATALOG_TABLES))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    pool.open()
+    apply_migrations(pool.get())
+    load_usernames()
+    if COORDINATOR_ENABLED:
+        writer.start()
+    if SNAPSHOT_ENABLED:
+        catalog.start(DB_PATH)
+    yield
+    if SNAPSHOT_ENABLED:
+        catalog.stop()
+    password_hasher.shutdown()
+    async_db.shutdown()
+    writer.stop()
+    pool.close_all()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    stats = instrumentation.RequestStats()
+    token = instrumentation.current_request.set(stats)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        instrumentation.current_request.reset(token)
+    endpoint = request.scope.get("endpoint")
+    route = _route_paths.get(endpoint, "unmatched")
+    instrumentation.record_request(
+        request.method, route, response.status_code,
+        time.perf_counter() - started, stats)
+    response.headers['X-Query-Count'] = str(stats.queries)
+    return response
+
+
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy(request: Request, exc: PasswordHasherBusy):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={'error': "server is busy, please retry later"},
+        headers={'Retry-After': str(exc.retry_after)})
+
+
+@app.exception_handler(InvalidSession)
+async def invalid_session(request: Request, exc: InvalidSession):
+    return JSONResponse(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        content={'error': exc.reason},
+        headers={'WWW-Authenticate': "Bearer"})
 
-app = FastAPI()
+
+@app.exception_handler(InvalidFields)
+async def invalid_fields(request: Request, exc: InvalidFields):
+    return JSONResponse(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        content={'error': str(exc)})
+
+
+async def session_username(authorization: Optional[str] = Header(None)) -> Optional[str]:
+    return bearer_username(authorization)
+
+
+def acting_user(username: Optional[str], session: Optional[str]) -> str:
+    '''the user a request acts for: the session's, else the username parameter'''
+    if session is None:
+        if username is None:
+            raise InvalidSession("log in or pass a username")
+        return username
+    if username is not None and username != session:
+        raise InvalidSession(f"session token is not for user {username}")
+    return session
+
+
+async def package_fields(
+    fields: Optional[str] = None, expand: Optional[str] = None) -> PackageFields:
+    '''sparse fieldset of a package listing, see fieldsets'''
+    return parse_package_fields(fields, expand)
+
+
+MAX_BATCH_SIZE = 1000
+MAX_SEARCH_PAGE = 100
+
+info_responses = ResponseCache("info", ["info"], maxsize=16)
+popular_responses = ResponseCache("popular_packages", ("sales",) + PACKAGE_TABLES)
+country_responses = ResponseCache("packages_by_country", PACKAGE_TABLES)
+destination_responses = ResponseCache("packages_by_destination", PACKAGE_TABLES)
+itinerary_responses = ResponseCache(
+    "itinerary", ("order", "flight") + PACKAGE_TABLES, maxsize=4096, per_user=True)
 
 
 class UserForm(BaseModel):
@@ -34,66 +153,189 @@ class UserForm(BaseModel):
 
 
 @app.get("/info/company")
-async def company_info():
-    return {"info": db_get_info("company_info")}
+async def company_info(request: Request):
+    return await info_responses.serve(
+        request, lambda: _info("info", "company_info"))
 
 @app.get("/info/contact")
-async def company_info():
-    return {"contact": db_get_info("company_contact")}
+async def company_info(request: Request):
+    return await info_responses.serve(
+        request, lambda: _info("contact", "company_contact"))
+
+async def _info(key: str, info_name: str):
+    return {key: await db_get_info(info_name)}
 
 @app.get("/package/popular")
-async def popular_packages(batch: Optional[int] = 4, showed_package_ids: Optional[List[int]] = Query(None)):
+async def popular_packages(
+    request: Request,
+    batch: Optional[int] = 4,
+    showed_package_ids: Optional[List[int]] = Query(None),
+    cursor: Optional[str] = None,
+    fields: PackageFields = Depends(package_fields)):
     if showed_package_ids is None:
         showed_package_ids = []
-    return {"packages": db_get_popular_packages(batch, showed_package_ids)}
+    if cursor is not None:
+        try:
+            decode_popular_cursor(cursor)
+        except ValueError:
+            return JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={'error': "invalid cursor!"})
+
+    async def load():
+        packages, next_cursor = await db_get_popular_packages_page(
+            batch, showed_package_ids, cursor, fields)
+        return {"packages": project_packages(packages, fields), "next_cursor": next_cursor}
+
+    return await popular_responses.serve(request, load)
+
+@app.get("/package/trending")
+async def trending_packages(
+    limit: int = Query(10, ge=1, le=MAX_SEARCH_PAGE),
+    fields: PackageFields = Depends(package_fields)):
+    packages = await db_get_trending_packages(limit, fields)
+    return {"packages": project_packages(packages, fields)}
+
+@app.get("/package/batch")
+async def query_packages_by_ids(
+    response: Response,
+    ids: List[str] = Query(...),
+    fields: PackageFields = Depends(package_fields)):
+    # accepts both ?ids=1&ids=2 and ?ids=1,2
+    try:
+        package_ids = [int(i) for value in ids for i in value.split(",") if i.strip()]
+    except ValueError:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {'error': "ids must be integers!"}
+    if len(package_ids) > MAX_BATCH_SIZE:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {'error': f"at most {MAX_BATCH_SIZE} ids per request!"}
+    packages = await db_get_packages_by_ids(package_ids, fields)
+    return {"packages": project_packages(packages, fields)}
+
+@app.get("/package/search")
+async def search_packages(
+    q: str,
+    limit: int = Query(10, ge=1, le=MAX_SEARCH_PAGE),
+    offset: int = Query(0, ge=0),
+    prefix: bool = True,
+    fields: PackageFields = Depends(package_fields)):
+    packages = await db_search_packages(q, limit, offset, prefix, fields)
+    return {
+        "packages": project_packages(packages, fields),
+        "next_offset": offset + limit if len(packages) == limit else None,
+    }
+
+@app.get("/package/query")
+async def query_packages(
+    country: Optional[str] = None,
+    destination: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    min_duration: Optional[int] = Query(None, ge=0),
+    max_duration: Optional[int] = Query(None, ge=0),
+    sort: str = Query("num_of_sales", regex="^(" + "|".join(PACKAGE_SORTS) + ")$"),
+    order: Optional[str] = Query(None, regex="^(asc|desc)$"),
+    limit: int = Query(20, ge=1, le=MAX_SEARCH_PAGE),
+    offset: int = Query(0, ge=0),
+    price_bucket: float = Query(500, gt=0),
+    fields: PackageFields = Depends(package_fields)):
+    # most popular first, cheapest or shortest first
+    descending = order == "desc" if order is not None else sort == "num_of_sales"
+    packages, facets = await db_query_packages(
+        country, destination, min_price, max_price, min_duration, max_duration,
+        sort, descending, limit, offset, price_bucket, fields)
+    return {
+        "packages": project_packages(packages, fields),
+        "facets": facets,
+        "next_offset": offset + limit if offset + limit < facets["total"] else None,
+    }
 
 @app.get("/package/country")
-async def query_packages_by_country(country: str):
-    return {"packages": db_get_packages_by_country(country)}
+async def query_packages_by_country(
+    request: Request,
+    country: str,
+    stream: Optional[str] = Query(None, regex=STREAM_FORMAT_PATTERN),
+    fields: PackageFields = Depends(package_fields)):
+    if stream:
+        packages = iter_packages_by_country(country, fields=fields)
+        return stream_response(stream, "packages", project_packages(packages, fields))
+    async def load():
+        packages = await db_get_packages_by_country(country, fields)
+        return {"packages": project_packages(packages, fields)}
+    return await country_responses.serve(request, load)
 
 @app.get("/package/destination")
-async def query_packages_by_destination(destination: str):
-    return {"package": db_get_packages_by_destination(destination)}
+async def query_packages_by_destination(
+    request: Request,
+    destination: str,
+    stream: Optional[str] = Query(None, regex=STREAM_FORMAT_PATTERN),
+    fields: PackageFields = Depends(package_fields)):
+    if stream:
+        packages = iter_packages_by_destination(destination, fields=fields)
+        return stream_response(stream, "package", project_packages(packages, fields))
+    async def load():
+        packages = await db_get_packages_by_destination(destination, fields)
+        return {"package": project_packages(packages, fields)}
+    return await destination_responses.serve(request, load)
 
 @app.get("/guide/available")
 async def available_guide(undesired_guide_ids: Optional[List[int]] = Query(None)):
     if undesired_guide_ids is None:
         undesired_guide_ids = []
-    return {"new_guide": get_available_guide(undesired_guide_ids)}
+    return {"new_guide": await get_available_guide(undesired_guide_ids)}
 
 @app.get("/hotel/available")
 async def available_hotel(destination: str, undesired_hotel_ids: Optional[List[int]] = Query(None)):
     if undesired_hotel_ids is None:
         undesired_hotel_ids = []
-    return {"new_hotel": get_available_hotel(destination, undesired_hotel_ids)}
+    return {"new_hotel": await get_available_hotel(destination, undesired_hotel_ids)}
 
 @app.get("/flight/available")
 async def available_flight(undesired_flight_ids: Optional[List[int]] = Query(None)):
     if undesired_flight_ids is None:
         undesired_flight_ids = []
-    return {"new_flight": get_available_flight(undesired_flight_ids)}
+    return {"new_flight": await get_available_flight(undesired_flight_ids)}
 
 @app.get("/restaurant/available")
 async def change_restaurant(destination: str, old_restaurant_name: str):
     return {
-        "new_restaurant": get_nearest_restaurant(
+        "new_restaurant": await get_nearest_restaurant(
                         destination,
                         old_restaurant_name
                     )
     }
 
+@app.get("/restaurant/nearest")
+async def nearest_restaurants(
+    destination: str,
+    response: Response,
+    k: int = Query(5, ge=1, le=100),
+    latitude: Optional[float] = None,
+    longitude: Optional[float] = None,
+    hotel_id: Optional[int] = None,
+    old_restaurant_name: Optional[str] = None):
+    nearest = await get_nearest_restaurants(
+        destination, k, latitude, longitude, hotel_id, old_restaurant_name)
+    if nearest is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {'error': "pass latitude and longitude, or a hotel or restaurant with coordinates!"}
+    return {"restaurants": [
+        {"restaurant": restaurant, "distance_km": round(distance, 3)}
+        for distance, restaurant in nearest
+    ]}
+
 @app.get("/user/checkname")
 async def check_username(username: str):
-    user = get_user(username)
-    if user:
-        return {'result': False}
-    else:
-        return {'result': True}
+    return {'result': not await user_exists(username)}
 
 @app.post("/user/register", status_code=status.HTTP_201_CREATED)
 async def register(form: UserForm, response: Response):
     try:
-        create_user(form.username, form.password)
+        # skip hashing for names that are known to be taken
+        if await user_exists(form.username):
+            raise sqlite3.IntegrityError(form.username)
+        await insert_user(await password_hasher.new_user(form.username, form.password))
         return {'message': f"user {form.username} is created successfully"}
     except sqlite3.IntegrityError as e:
         response.status_code = status.HTTP_400_BAD_REQUEST
@@ -101,60 +343,163 @@ async def register(form: UserForm, response: Response):
 
 @app.post("/user/login")
 async def login(form: UserForm, response: Response):
-    if validate_user_password(form.username, form.password):
-        return {'message': "login success", 'username': form.username}
+    user = await get_user(form.username) if await user_exists(form.username) else None
+    if user and await password_hasher.verify(user, form.password):
+        if user.needs_rehash():
+            await update_user_password_key(
+                await password_hasher.new_user(form.username, form.password))
+        return {
+            'message': "login success",
+            'username': form.username,
+            'token': issue_token(form.username),
+            'token_type': "bearer",
+            'expires_in': SESSION_TTL,
+        }
     else:
         response.status_code = status.HTTP_401_UNAUTHORIZED
         return {'error': "invaild username or password!"}
 
 @app.get("/user/orders")
-async def get_user_packages(username: str):
-    return {'packages': get_packages_by_username(username)}
+async def get_user_packages(
+    username: Optional[str] = None,
+    stream: Optional[str] = Query(None, regex=STREAM_FORMAT_PATTERN),
+    session: Optional[str] = Depends(session_username)):
+    username = acting_user(username, session)
+    if stream:
+        return stream_response(stream, "packages", iter_packages_by_username(username))
+    return {'packages': await get_packages_by_username(username)}
 
-@app.put("/user/order/guide")
-async def change_order_guide(username: str, destination: str, response: Response):
-    order = get_user_order(username, destination)
-    if order:
-        new_guide = change_user_guide(order)
-        return {'message': "change success", 'new_guide': new_guide}
-    else:
+@app.get("/user/itinerary")
+async def get_user_itinerary(
+    request: Request,
+    username: Optional[str] = None,
+    session: Optional[str] = Depends(session_username)):
+    username = acting_user(username, session)
+    async def load():
+        return {'itinerary': await get_itinerary(username)}
+    return await itinerary_responses.serve(request, load, user=username)
+
+async def modify_order(
+    username: str, destination: str, response: Response, **changes):
+    package_id = await get_package_id_by_destination(destination)
+    result = None
+    if package_id is not None:
+        result = await modify_user_order(username, package_id, **changes)
+    if result is None:
         response.status_code = status.HTTP_404_NOT_FOUND
         return {'error': f"User '{username}' does not have order to {destination}."}
+    return {
+        'message': "change success",
+        **{f'new_{name}': attachment for name, attachment in result.items()}
+    }
+
+@app.put("/user/order/guide")
+async def change_order_guide(
+    destination: str,
+    response: Response,
+    username: Optional[str] = None,
+    session: Optional[str] = Depends(session_username)):
+    return await modify_order(
+        acting_user(username, session), destination, response, change_guide=True)
 
 @app.put("/user/order/flight")
-async def change_order_flight(username: str, destination: str, flight_id: int, response: Response):
-    order = get_user_order(username, destination)
-    if order:
-        new_flight = change_user_flight(order, flight_id)
-        return {'message': "change success", 'new_flight': new_flight}
-    else:
-        response.status_code = status.HTTP_404_NOT_FOUND
-        return {'error': f"User '{username}' does not have order to {destination}."}
+async def change_order_flight(
+    destination: str,
+    flight_id: int,
+    response: Response,
+    username: Optional[str] = None,
+    session: Optional[str] = Depends(session_username)):
+    return await modify_order(
+        acting_user(username, session), destination, response, new_flight_id=flight_id)
 
 @app.put("/user/order/hotel")
-async def change_order_hotel(username: str, destination: str, hotel_id: int, response: Response):
-    order = get_user_order(username, destination)
-    if order:
-        new_hotel = change_user_hotel(order, hotel_id)
-        return {'message': "change success", 'new_hotel': new_hotel}
-    else:
-        response.status_code = status.HTTP_404_NOT_FOUND
-        return {'error': f"User '{username}' does not have order to {destination}."}
+async def change_order_hotel(
+    destination: str,
+    hotel_id: int,
+    response: Response,
+    username: Optional[str] = None,
+    session: Optional[str] = Depends(session_username)):
+    return await modify_order(
+        acting_user(username, session), destination, response, new_hotel_id=hotel_id)
+
+@app.patch("/user/order")
+async def change_order(
+    destination: str,
+    response: Response,
+    username: Optional[str] = None,
+    guide: bool = False,
+    hotel_id: Optional[int] = None,
+    flight_id: Optional[int] = None,
+    session: Optional[str] = Depends(session_username)):
+    username = acting_user(username, session)
+    if not guide and hotel_id is None and flight_id is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {'error': "nothing to change: set guide, hotel_id or flight_id!"}
+    return await modify_order(
+        username, destination, response,
+        change_guide=guide, new_hotel_id=hotel_id, new_flight_id=flight_id)
 
 @app.post("/order", status_code=status.HTTP_201_CREATED)
-async def create_user_order(order: Order, response: Response):
+async def create_user_order(
+    order: Order,
+    response: Response,
+    session: Optional[str] = Depends(session_username)):
+    acting_user(order.username, session)
     try:
-        create_order(order.username, order.package_id)
+        await create_order(order.username, order.package_id)
         return {'message': f"user {order.username}\'s order is created successfully"}
     except sqlite3.IntegrityError as e:
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {'error': f"user {order.username}\'s order already exists!"}
 
+@app.post("/order/batch")
+async def create_user_orders(
+    orders: List[Order],
+    response: Response,
+    session: Optional[str] = Depends(session_username)):
+    for order in orders:
+        acting_user(order.username, session)
+    if len(orders) > MAX_BATCH_SIZE:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {'error': f"at most {MAX_BATCH_SIZE} orders per request!"}
+    results = await create_orders([(o.username, o.package_id) for o in orders])
+    if any(result == "created" for result, _ in results):
+        response.status_code = status.HTTP_201_CREATED
+    return {'results': [
+        {
+            'username': o.username,
+            'package_id': o.package_id,
+            'result': result,
+            'order': created,
+        } for o, (result, created) in zip(orders, results)
+    ]}
+
 @app.delete("/order/cancel")
-async def cancel_order(username: str, destination: str, response: Response):
-    package_id = get_package_id_by_destination(destination)
-    if delete_order(username, package_id):
+async def cancel_order(
+    destination: str,
+    response: Response,
+    username: Optional[str] = None,
+    session: Optional[str] = Depends(session_username)):
+    username = acting_user(username, session)
+    package_id = await get_package_id_by_destination(destination)
+    if await delete_order(username, package_id):
         return {'message': f"Cancel successfully"}
     else:
         response.status_code = status.HTTP_404_NOT_FOUND
         return {'error': "order does not exist!"}
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return {'caches': cache_stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    counters = []
+    for name, stats in cache_stats().items():
+        counters.append(("trippy_cache_hits_total", {'cache': name}, stats['hits']))
+        counters.append(("trippy_cache_misses_total", {'cache': name}, stats['misses']))
+    return instrumentation.render_metrics(counters)
+
+
+# endpoint function -> route template, for the metrics labels
+_route_paths = {route.endpoint: route.path for route in app.routes}
@@ -0,0 +1,190 @@
+import re
+import sqlite3
+import sys
+from typing import Any, List, Tuple
+
+
+def _count_catalog_writes(table: str, event: str) -> str:
+    '''trigger bumping catalog_version after `event` (INSERT, DELETE, UPDATE OF ...) on `table`'''
+    name = f"{table}_catalog_version_{event.split()[0].lower()}"
+    return f"""CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table} BEGIN
+            UPDATE catalog_version SET version = version + 1;
+        END"""
+
+
+# (version, description, statements); versions must be strictly increasing.
+# A migration is applied once, in its own transaction, and recorded in
+# PRAGMA user_version. Never edit a migration that has been released, add a
+# new one instead.
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "indexes for hot lookup columns", [
+        # order.username is already covered by the (username, package_id)
+        # primary key index
+        'CREATE INDEX IF NOT EXISTS idx_package_country ON package(country)',
+        'CREATE INDEX IF NOT EXISTS idx_package_destination ON package(destination)',
+        'CREATE INDEX IF NOT EXISTS idx_package_popularity ON package(num_of_sales, id)',
+        'CREATE INDEX IF NOT EXISTS idx_hotel_destination ON hotel(destination)',
+        'CREATE INDEX IF NOT EXISTS idx_restaurant_destination ON restaurant(destination, name)',
+    ]),
+    (2, "versioned password hash parameters", [
+        # existing rows were hashed with version 1 (sha256, 100000 rounds)
+        'ALTER TABLE user ADD COLUMN hash_version INTEGER NOT NULL DEFAULT 1',
+    ]),
+    (3, "coordinates of hotels and restaurants", [
+        # NULL until geocoded; rows without coordinates are left out of
+        # nearest-restaurant searches
+        'ALTER TABLE hotel ADD COLUMN latitude REAL',
+        'ALTER TABLE hotel ADD COLUMN longitude REAL',
+        'ALTER TABLE restaurant ADD COLUMN latitude REAL',
+        'ALTER TABLE restaurant ADD COLUMN longitude REAL',
+    ]),
+    (4, "full-text index of packages", [
+        # external content: the text stays in package, the index is kept in
+        # sync by the triggers below
+        """CREATE VIRTUAL TABLE IF NOT EXISTS package_fts USING fts5(
+            title, description, country, destination,
+            content='package', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+        """CREATE TRIGGER IF NOT EXISTS package_fts_insert AFTER INSERT ON package BEGIN
+            INSERT INTO package_fts(rowid, title, description, country, destination)
+            VALUES (new.id, new.title, new.description, new.country, new.destination);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS package_fts_delete AFTER DELETE ON package BEGIN
+            INSERT INTO package_fts(package_fts, rowid, title, description, country, destination)
+            VALUES ('delete', old.id, old.title, old.description, old.country, old.destination);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS package_fts_update AFTER UPDATE OF
+            title, description, country, destination ON package BEGIN
+            INSERT INTO package_fts(package_fts, rowid, title, description, country, destination)
+            VALUES ('delete', old.id, old.title, old.description, old.country, old.destination);
+            INSERT INTO package_fts(rowid, title, description, country, destination)
+            VALUES (new.id, new.title, new.description, new.country, new.destination);
+        END""",
+        "INSERT INTO package_fts(package_fts) VALUES ('rebuild')",
+    ]),
+    (5, "composite indexes for faceted package queries", [
+        # country filter sorted by popularity or price, id breaking ties as in
+        # the queries; price and duration ranges are checked from the index
+        # entries, before any row is read
+        'CREATE INDEX IF NOT EXISTS idx_package_country_sales '
+        'ON package(country, num_of_sales, id, price, duration)',
+        'CREATE INDEX IF NOT EXISTS idx_package_country_price '
+        'ON package(country, price, id, duration)',
+        'CREATE INDEX IF NOT EXISTS idx_package_price ON package(price, id, duration)',
+        # a prefix of both country indexes above
+        'DROP INDEX IF EXISTS idx_package_country',
+    ]),
+    (6, "popularity counters maintained by order triggers", [
+        # julian day the order was placed, NULL for orders placed before
+        'ALTER TABLE "order" ADD COLUMN ordered_at REAL',
+        # sales per package and julian day number, for the trending score
+        """CREATE TABLE IF NOT EXISTS package_sales_daily (
+            day INTEGER NOT NULL,
+            package_id INTEGER NOT NULL,
+            sales INTEGER NOT NULL,
+            PRIMARY KEY (day, package_id)
+        ) WITHOUT ROWID""",
+        """CREATE TRIGGER IF NOT EXISTS order_sales_insert AFTER INSERT ON "order" BEGIN
+            UPDATE "order" SET ordered_at = julianday('now')
+            WHERE rowid = new.rowid AND ordered_at IS NULL;
+            UPDATE package SET num_of_sales = num_of_sales + 1 WHERE id = new.package_id;
+            INSERT INTO package_sales_daily (day, package_id, sales)
+            VALUES (CAST(coalesce(new.ordered_at, julianday('now')) AS INTEGER), new.package_id, 1)
+            ON CONFLICT (day, package_id) DO UPDATE SET sales = sales + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS order_sales_delete AFTER DELETE ON "order" BEGIN
+            UPDATE package SET num_of_sales = num_of_sales - 1 WHERE id = old.package_id;
+            UPDATE package_sales_daily SET sales = sales - 1
+            WHERE day = CAST(old.ordered_at AS INTEGER) AND package_id = old.package_id;
+            DELETE FROM package_sales_daily
+            WHERE day = CAST(old.ordered_at AS INTEGER) AND package_id = old.package_id
+            AND sales <= 0;
+        END""",
+    ]),
+    (7, "duration index for faceted package queries", [
+        # sort=duration pages walk it in (duration, id) order; duration ranges
+        # and their facets are read from the index entries alone
+        'CREATE INDEX IF NOT EXISTS idx_package_duration '
+        'ON package(duration, id, price, country)',
+    ]),
+    (8, "change counter of the catalog tables", [
+        # the catalog snapshot is rebuilt when it changes. The num_of_sales
+        # updates of the order triggers leave it alone, so orders do not
+        # rebuild the snapshot
+        'CREATE TABLE IF NOT EXISTS catalog_version (version INTEGER NOT NULL)',
+        'INSERT INTO catalog_version (version) '
+        'SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM catalog_version)',
+        _count_catalog_writes(
+            "package", "UPDATE OF id, title, country, destination, duration, price, "
+            "description, hotel_id, guide_id, car_rental_id, pic_url"),
+    ] + [
+        _count_catalog_writes(table, "UPDATE")
+        for table in ("info", "hotel", "guide", "car_rental", "restaurant", "flight")
+    ] + [
+        _count_catalog_writes(table, event)
+        for table in ("info", "package", "hotel", "guide", "car_rental", "restaurant", "flight")
+        for event in ("INSERT", "DELETE")
+    ]),
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(conn: sqlite3.Connection) -> int:
+    '''bring the schema up to date and return the resulting version'''
+    applied = False
+    for version, description, statements in MIGRATIONS:
+        if get_schema_version(conn) >= version:
+            continue
+        # IMMEDIATE so that concurrently starting workers apply it only once
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version={int(version)}")
+            conn.commit()
+            applied = True
+        except Exception:
+            conn.rollback()
+            raise
+    if applied:
+        conn.execute("ANALYZE")
+        conn.commit()
+    return get_schema_version(conn)
+
+
+def explain_query_plan(conn: sqlite3.Connection, sql: str, params: Any = ()) -> List[str]:
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def uses_index(plan: List[str], sql: str) -> bool:
+    '''False if a step of `sql` reads a whole table.
+
+    A SCAN, of a covering index too, reads every row unless the statement has
+    a LIMIT and takes its order from the scan (no temp b-tree for ORDER BY),
+    so that it stops early. Virtual tables (FTS5, json_each) and constant
+    rows are not table scans. A temp b-tree sorting or grouping the rows of
+    index searches is accepted: it is bounded by the rows they found.
+    Statements meant to read every row say so with a `/* full scan: why */`
+    comment.
+    '''
+    if "/* full scan:" in sql:
+        return True
+    bounded = re.search(r"\bLIMIT\b", sql, re.IGNORECASE) is not None \
+        and not any("TEMP B-TREE FOR ORDER BY" in detail for detail in plan)
+    for detail in plan:
+        if detail.startswith("SCAN") and "VIRTUAL TABLE" not in detail \
+                and "CONSTANT ROW" not in detail and not bounded:
+            return False
+    return True
+
+
+if __name__ == "__main__":
+    # python migrations.py [db_path]; query plans are checked by benchmarks.plans
+    with sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else "trippy.db") as conn:
+        print(f"schema version {apply_migrations(conn)}")
@@ -0,0 +1,102 @@
+import asyncio
+import hmac
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from data import (
+    CURRENT_PASSWORD_HASH_VERSION,
+    User,
+    derive_password_key,
+)
+
+
+class PasswordHasherBusy(Exception):
+    '''raised when the hashing queue is full; the API answers 503'''
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("password hashing queue is full")
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    '''Run PBKDF2 key derivation off the event loop.
+
+    Jobs go to a thread pool (hashlib releases the GIL while deriving) or a
+    process pool. At most `max_pending` jobs may be queued or running at
+    once, further calls raise PasswordHasherBusy instead of piling up.
+    '''
+
+    def __init__(
+        self,
+        executor_kind: str = "thread",
+        max_workers: int = 4,
+        max_pending: int = 64,
+        retry_after: int = 1) -> None:
+        if executor_kind not in ("thread", "process"):
+            raise ValueError(f"unknown executor kind {executor_kind!r}")
+        self.executor_kind = executor_kind
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self._executor: Optional[Executor] = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "PasswordHasher":
+        return cls(
+            executor_kind=os.environ.get("TRIPPY_HASH_EXECUTOR", "thread"),
+            max_workers=int(os.environ.get("TRIPPY_HASH_WORKERS", 4)),
+            max_pending=int(os.environ.get("TRIPPY_HASH_MAX_PENDING", 64)),
+        )
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.executor_kind == "process":
+                    self._executor = ProcessPoolExecutor(self.max_workers)
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        self.max_workers, thread_name_prefix="password-hasher")
+            return self._executor
+
+    async def derive(self, password: str, salt: bytes, version: int) -> bytes:
+        executor = self._get_executor()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise PasswordHasherBusy(self.retry_after)
+            self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, derive_password_key, password, salt, version)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    async def new_user(self, username: str, password: str) -> User:
+        '''a User with a fresh salt, hashed with the current parameters'''
+        salt = os.urandom(32)
+        key = await self.derive(password, salt, CURRENT_PASSWORD_HASH_VERSION)
+        return User(
+            name=username,
+            password_key=key,
+            salt=salt,
+            hash_version=CURRENT_PASSWORD_HASH_VERSION)
+
+    async def verify(self, user: User, password: str) -> bool:
+        key = await self.derive(password, user.salt, user.hash_version)
+        return hmac.compare_digest(key, user.password_key)
+
+    def pending(self) -> int:
+        return self._pending
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+password_hasher = PasswordHasher.from_env()
@@ -0,0 +1,103 @@
+'''Popularity of packages: the popular ranking and the trending score.
+
+The triggers of migration 6 keep `package.num_of_sales` current on every
+order insert and delete. They also count sales per package and julian day
+number in `package_sales_daily`.
+
+PopularRanking keeps the top RANKING_SIZE packages as (num_of_sales, id) keys
+in memory, in ranking order, so /package/popular pages are cut from a list
+instead of a query. Order writes of this process pass the new counts to
+`update` once they commit, in commit order. When another process writes, the write coordinator invalidates
+"popularity" and the ranking is reloaded from idx_package_popularity. It is
+also reloaded after `max_age` seconds, like a cache entry.
+
+The trending score weighs each day's sales by 0.5 ** (age / half life),
+so a sale counts half as much after TRIPPY_TRENDING_HALF_LIFE days
+(default 7). Days older than four half lives are left out.
+'''
+import bisect
+import os
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+from reloadable import Reloadable
+
+RANKING_SIZE = int(os.environ.get("TRIPPY_POPULAR_RANKING_SIZE", 1000))
+TRENDING_HALF_LIFE = float(os.environ.get("TRIPPY_TRENDING_HALF_LIFE", 7))
+TRENDING_WINDOW = max(int(4 * TRENDING_HALF_LIFE), 1)
+
+
+def trending_weights(
+    half_life: float = TRENDING_HALF_LIFE, window: int = TRENDING_WINDOW) -> List[float]:
+    '''weight of a day's sales by age in days, today first'''
+    return [0.5 ** (age / half_life) for age in range(window)]
+
+
+# ranking keys sort ascending in ranking order: num_of_sales DESC, id DESC
+def _key(num_of_sales: int, package_id: int) -> Tuple[int, int]:
+    return -num_of_sales, -package_id
+
+
+class PopularRanking(Reloadable):
+
+    def __init__(self, size: int = RANKING_SIZE, max_age: float = 300) -> None:
+        super().__init__(max_age)
+        self.size = size
+        self._keys: List[Tuple[int, int]] = []
+        self._by_id: Dict[int, Tuple[int, int]] = {}
+        # the ranking holds every package, so any package may enter it
+        self._complete = False
+
+    def _load(self, conn: sqlite3.Connection) -> None:
+        rows = conn.execute("""
+            SELECT num_of_sales, id FROM package
+            ORDER BY num_of_sales DESC, id DESC LIMIT :size
+        """, {"size": self.size}).fetchall()
+        self._keys = [_key(num_of_sales, package_id) for num_of_sales, package_id in rows]
+        self._by_id = {-key[1]: key for key in self._keys}
+        self._complete = len(rows) < self.size
+
+    def update(self, package_id: int, num_of_sales: int) -> None:
+        '''record the new num_of_sales of a package after an order write.
+
+        The held keys are always the exact top of the ranking. A package is
+        only (re)inserted if it ranks above the last held key, since a
+        package outside the ranking may otherwise be ahead of it. The
+        ranking can thus shrink, and is reloaded once half of it is gone.
+        '''
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            old = self._by_id.pop(package_id, None)
+            if old is not None:
+                del self._keys[bisect.bisect_left(self._keys, old)]
+            key = _key(num_of_sales, package_id)
+            if self._complete or (self._keys and key < self._keys[-1]):
+                bisect.insort(self._keys, key)
+                self._by_id[package_id] = key
+                if len(self._keys) > self.size:
+                    del self._by_id[-self._keys.pop()[1]]
+                    self._complete = False
+            if not self._complete and len(self._keys) < self.size // 2:
+                self._stale = True
+
+    def page(
+        self,
+        batch: int,
+        showed_package_ids: List[int],
+        after: Optional[Tuple[int, int]] = None) -> Optional[List[Tuple[int, int]]]:
+        '''(num_of_sales, id) of the next page, None if it runs past the ranking'''
+        showed = set(showed_package_ids)
+        page = []
+        with self._lock:
+            start = 0
+            if after is not None:
+                start = bisect.bisect_right(self._keys, _key(*after))
+            for key in self._keys[start:]:
+                if len(page) >= batch:
+                    break
+                if -key[1] not in showed:
+                    page.append((-key[0], -key[1]))
+            if len(page) < batch and not self._complete:
+                return None
+        return page
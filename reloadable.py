@@ -0,0 +1,40 @@
+'''In-memory data loaded from the database and reloaded when it goes stale.
+
+Subclasses implement `_load(conn)`. Callers check `fresh()` and call
+`refresh(conn)` when it is not: after `mark_stale()` (an invalidation, or
+the subclass finding its data unusable) or once `max_age` seconds have
+passed since the last load. `_load` runs under `_lock`, which subclasses
+also hold while they change the data in place.
+'''
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+class Reloadable:
+
+    def __init__(self, max_age: Optional[float] = None) -> None:
+        # None: never expires, only mark_stale makes it stale
+        self.max_age = max_age
+        self._loaded_at: Optional[float] = None
+        self._stale = False
+        self._lock = threading.Lock()
+
+    def fresh(self) -> bool:
+        if self._loaded_at is None or self._stale:
+            return False
+        return self.max_age is None or time.monotonic() - self._loaded_at < self.max_age
+
+    def refresh(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            # cleared first: a mark_stale during the query must not be lost
+            self._stale = False
+            self._load(conn)
+            self._loaded_at = time.monotonic()
+
+    def mark_stale(self) -> None:
+        self._stale = True
+
+    def _load(self, conn: sqlite3.Connection) -> None:
+        raise NotImplementedError
@@ -0,0 +1,82 @@
+'''Cache of encoded JSON responses with strong ETags.
+
+Read-mostly routes hand their loader to a ResponseCache, which stores the
+encoded body and its ETag per path and query string. Hits skip both the
+lookups and the pydantic serialization, and a request whose If-None-Match
+matches the current ETag gets an empty 304. The entries live in caches
+registered with cache.register, so `invalidate` on a table the route reads
+drops them together with the db_utils caches. Clients may reuse a response
+for TRIPPY_RESPONSE_MAX_AGE seconds (default 60) before revalidating.
+Responses for a logged in user are also keyed by the user, and marked
+private so shared caches do not store them. Caches created with
+`per_user=True` are cleared per user by cache.invalidate_users.
+'''
+import hashlib
+import json
+import os
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from fastapi import Request, Response, status
+from fastapi.encoders import jsonable_encoder
+
+import cache
+
+MAX_AGE = int(os.environ.get("TRIPPY_RESPONSE_MAX_AGE", 60))
+
+
+def encode(content: Any) -> bytes:
+    '''same bytes as JSONResponse renders for `content`'''
+    return json.dumps(
+        jsonable_encoder(content),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def etag_for(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    '''If-None-Match uses the weak comparison, W/ prefixes are ignored'''
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
+
+class ResponseCache:
+
+    def __init__(
+        self, name: str, tables: Iterable[str], maxsize: int = 256, per_user: bool = False) -> None:
+        # keys are (path, query, user)
+        user_of = (lambda key: key[2]) if per_user else None
+        self.cache = cache.register(f"response:{name}", tables, maxsize, user_of)
+
+    async def serve(
+        self,
+        request: Request,
+        load: Callable[[], Awaitable[Any]],
+        user: Optional[str] = None) -> Response:
+        '''cached body for `request`, or the result of `await load()` encoded and cached'''
+        key = (request.url.path, tuple(sorted(request.query_params.multi_items())), user)
+        found, entry = (self.cache.get(key) if cache.CACHE_ENABLED else (False, None))
+        if found:
+            body, etag = entry
+        else:
+            generation = self.cache.generation
+            body = encode(await load())
+            etag = etag_for(body)
+            if cache.CACHE_ENABLED:
+                self.cache.set(key, (body, etag), generation)
+        scope = "public" if user is None else "private"
+        headers = {"ETag": etag, "Cache-Control": f"{scope}, max-age={MAX_AGE}"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None and etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(body, media_type="application/json", headers=headers)
@@ -0,0 +1,118 @@
+'''sqlite3 row factories that build pydantic models straight from rows.
+
+One RowMapper is compiled per model. It maps columns by name using
+`cursor.description`, so `SELECT *` no longer depends on the column order
+in the table. Models are built with `construct`, skipping validation: rows
+come from our own schema and are trusted. Only the cheap scalar coercions
+the API relies on are applied, e.g. the INTEGER `num_of_sales` column
+stays a `str` as declared on Package.
+'''
+import sqlite3
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar
+
+from pydantic import BaseModel
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+# (column index, field name, converter or None)
+_Plan = List[Tuple[int, str, Optional[Callable[[Any], Any]]]]
+
+_SCALAR_TYPES = (str, int, float)
+
+
+class RowMapper:
+
+    def __init__(self, model: Type[ModelT]) -> None:
+        self.model = model
+        self.converters: Dict[str, Optional[type]] = {}
+        for name, field in model.__fields__.items():
+            field_type = field.outer_type_
+            self.converters[name] = field_type if field_type in _SCALAR_TYPES else None
+        # plan of the last cursor.description seen; the description object
+        # stays the same for every row of one statement
+        self._last: Tuple[Any, _Plan] = (None, [])
+
+    def _compile(self, description: Tuple) -> _Plan:
+        return [
+            (i, column[0], self.converters[column[0]])
+            for i, column in enumerate(description)
+            if column[0] in self.converters
+        ]
+
+    def __call__(self, cursor: sqlite3.Cursor, row: Tuple) -> ModelT:
+        description = cursor.description
+        last_description, plan = self._last
+        if last_description is not description:
+            plan = self._compile(description)
+            self._last = (description, plan)
+        values = {}
+        for i, name, convert in plan:
+            value = row[i]
+            if convert is not None and value is not None and type(value) is not convert:
+                value = convert(value)
+            values[name] = value
+        return self.model.construct(**values)
+
+
+_mappers: Dict[type, RowMapper] = {}
+
+
+def row_factory(model: Type[ModelT]) -> RowMapper:
+    '''the compiled mapper of `model`, usable as `cursor.row_factory`'''
+    mapper = _mappers.get(model)
+    if mapper is None:
+        mapper = _mappers.setdefault(model, RowMapper(model))
+    return mapper
+
+
+def model_cursor(conn: sqlite3.Connection, model: Type[ModelT]) -> sqlite3.Cursor:
+    '''a cursor whose fetch* methods return `model` instances'''
+    cur = conn.cursor()
+    cur.row_factory = row_factory(model)
+    return cur
+
+
+def model_columns(model: Type[BaseModel]) -> Tuple[str, ...]:
+    '''fields of `model` stored as columns, i.e. all but nested models'''
+    return tuple(
+        name for name, field in model.__fields__.items()
+        if not (isinstance(field.type_, type) and issubclass(field.type_, BaseModel)))
+
+
+class JoinMapper:
+    '''row factory for a join that selects the columns of several models.
+
+    `select(*aliases)` lists `model_columns` of each model, prefixed with its
+    table alias, in the order the models were given. Each row is then cut
+    into one instance per model, or None where a LEFT JOIN found no row
+    (its first column, the id, is NULL).
+    '''
+
+    def __init__(self, *models: Type[BaseModel]) -> None:
+        self.models = models
+        self.columns = [model_columns(model) for model in models]
+
+    def select(self, *aliases: str) -> str:
+        return ", ".join(
+            f"{alias}.{column}"
+            for alias, columns in zip(aliases, self.columns)
+            for column in columns)
+
+    def __call__(self, cursor: sqlite3.Cursor, row: Tuple) -> Tuple[Optional[BaseModel], ...]:
+        instances = []
+        start = 0
+        for model, columns in zip(self.models, self.columns):
+            values = row[start:start + len(columns)]
+            start += len(columns)
+            if values[0] is None:
+                instances.append(None)
+                continue
+            converters = row_factory(model).converters
+            fields = {}
+            for name, value in zip(columns, values):
+                convert = converters[name]
+                if convert is not None and value is not None and type(value) is not convert:
+                    value = convert(value)
+                fields[name] = value
+            instances.append(model.construct(**fields))
+        return tuple(instances)
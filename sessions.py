@@ -0,0 +1,87 @@
+'''Signed session tokens issued by /user/login.
+
+A token is `<payload>.<signature>`: the base64url JSON {"sub": username,
+"exp": unix time} and its HMAC-SHA256 under TRIPPY_SESSION_SECRET. Tokens
+are verified statelessly, so any worker holding the secret accepts them and
+the password key is only derived once per session. Without the variable,
+gunicorn.conf.py generates one in the master before forking, so all workers
+share it, and a process started otherwise generates its own. Either way
+tokens die with the server, so set it in production.
+TRIPPY_SESSION_TTL is the token lifetime in seconds (default 12 hours).
+'''
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+from typing import Optional
+
+logger = logging.getLogger("trippy.sessions")
+
+SESSION_TTL = int(os.environ.get("TRIPPY_SESSION_TTL", 12 * 3600))
+
+
+class InvalidSession(Exception):
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _load_secret() -> bytes:
+    secret = os.environ.get("TRIPPY_SESSION_SECRET")
+    if secret:
+        return secret.encode("utf-8")
+    logger.warning("TRIPPY_SESSION_SECRET is not set, session tokens are only valid in this process")
+    return secrets.token_bytes(32)
+
+
+_secret = _load_secret()
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(_secret, payload.encode("utf-8"), hashlib.sha256).digest())
+
+
+def issue_token(username: str, ttl: int = SESSION_TTL) -> str:
+    payload = _b64encode(json.dumps(
+        {"sub": username, "exp": int(time.time()) + ttl},
+        separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_token(token: str) -> str:
+    '''username the token was issued to, raise InvalidSession if it is forged or expired'''
+    payload, _, signature = token.partition(".")
+    if not hmac.compare_digest(_sign(payload).encode("ascii"), signature.encode("utf-8")):
+        raise InvalidSession("invalid session token")
+    try:
+        claims = json.loads(_b64decode(payload))
+        username, expires = claims["sub"], claims["exp"]
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise InvalidSession("invalid session token")
+    if expires < time.time():
+        raise InvalidSession("session expired")
+    return username
+
+
+def bearer_username(authorization: Optional[str]) -> Optional[str]:
+    '''username of an `Authorization: Bearer <token>` header, None without one'''
+    if authorization is None:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise InvalidSession("expected a Bearer session token")
+    return verify_token(token.strip())
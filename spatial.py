@@ -0,0 +1,111 @@
+'''Grid index for k-nearest queries over latitude/longitude points.
+
+Points are projected onto a local equirectangular plane around their mean
+latitude, in kilometres. That is accurate to well under 1% at the scale of
+one destination. The plane is cut into square cells sized so that a cell
+holds a few points on average. A query visits rings of cells around the
+query point, nearest ring first. It stops once the k-th best distance is
+shorter than the distance to the next ring, so only a handful of cells are
+read however many points the destination has.
+'''
+import heapq
+import math
+from typing import Callable, Dict, Generic, Iterable, List, Optional, Tuple, TypeVar
+
+ItemT = TypeVar("ItemT")
+
+KM_PER_DEGREE = 6371.0 * math.pi / 180
+POINTS_PER_CELL = 4
+MIN_CELL_KM = 0.05
+
+
+class GridIndex(Generic[ItemT]):
+
+    def __init__(
+        self,
+        items: Iterable[ItemT],
+        position: Callable[[ItemT], Tuple[Optional[float], Optional[float]]]) -> None:
+        '''index the items for which `position(item)` is a (latitude, longitude)'''
+        points = []
+        for item in items:
+            latitude, longitude = position(item)
+            if latitude is not None and longitude is not None:
+                points.append((latitude, longitude, item))
+        self.size = len(points)
+        self._cells: Dict[Tuple[int, int], List[Tuple[float, float, ItemT]]] = {}
+        if not points:
+            return
+        mean_latitude = sum(p[0] for p in points) / len(points)
+        self._x_scale = KM_PER_DEGREE * math.cos(math.radians(mean_latitude))
+        projected = [(*self.project(lat, lon), item) for lat, lon, item in points]
+        xs = [p[0] for p in projected]
+        ys = [p[1] for p in projected]
+        area = max(max(xs) - min(xs), MIN_CELL_KM) * max(max(ys) - min(ys), MIN_CELL_KM)
+        self.cell_km = max(math.sqrt(area * POINTS_PER_CELL / len(points)), MIN_CELL_KM)
+        for x, y, item in projected:
+            self._cells.setdefault(self._cell(x, y), []).append((x, y, item))
+        columns = [cx for cx, _ in self._cells]
+        rows = [cy for _, cy in self._cells]
+        self._bounds = (min(columns), max(columns), min(rows), max(rows))
+
+    def project(self, latitude: float, longitude: float) -> Tuple[float, float]:
+        return longitude * self._x_scale, latitude * KM_PER_DEGREE
+
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        return math.floor(x / self.cell_km), math.floor(y / self.cell_km)
+
+    def _ring(self, cx: int, cy: int, radius: int):
+        '''cells at Chebyshev distance `radius` from (cx, cy), clipped to the grid'''
+        min_cx, max_cx, min_cy, max_cy = self._bounds
+        if radius == 0:
+            yield cx, cy
+            return
+        x_range = range(max(cx - radius, min_cx), min(cx + radius, max_cx) + 1)
+        for y in (cy - radius, cy + radius):
+            if min_cy <= y <= max_cy:
+                for x in x_range:
+                    yield x, y
+        y_range = range(max(cy - radius + 1, min_cy), min(cy + radius - 1, max_cy) + 1)
+        for x in (cx - radius, cx + radius):
+            if min_cx <= x <= max_cx:
+                for y in y_range:
+                    yield x, y
+
+    def nearest(
+        self,
+        latitude: float,
+        longitude: float,
+        k: int = 1,
+        exclude: Callable[[ItemT], bool] = lambda item: False) -> List[Tuple[float, ItemT]]:
+        '''up to k (distance in km, item) pairs, nearest first'''
+        if self.size == 0 or k <= 0:
+            return []
+        x, y = self.project(latitude, longitude)
+        cx, cy = self._cell(x, y)
+        min_cx, max_cx, min_cy, max_cy = self._bounds
+        # rings before the first and after the last cannot hold any cell of the grid
+        min_radius = max(min_cx - cx, cx - max_cx, min_cy - cy, cy - max_cy, 0)
+        max_radius = max(cx - min_cx, max_cx - cx, cy - min_cy, max_cy - cy, 0)
+        # distance from the query point to the border of its own cell: no
+        # point in ring r (r >= 1) is nearer than (r - 1) * cell_km + edge
+        edge = min(x - cx * self.cell_km, (cx + 1) * self.cell_km - x,
+                   y - cy * self.cell_km, (cy + 1) * self.cell_km - y)
+        # max-heap of the best k as (-distance, tiebreak, item)
+        best: List[Tuple[float, int, ItemT]] = []
+        seen = 0
+        for radius in range(min_radius, max_radius + 1):
+            if len(best) == k and radius > 0 and -best[0][0] <= (radius - 1) * self.cell_km + edge:
+                break
+            for cell in self._ring(cx, cy, radius):
+                for px, py, item in self._cells.get(cell, ()):
+                    if exclude(item):
+                        continue
+                    distance = math.hypot(px - x, py - y)
+                    seen += 1
+                    entry = (-distance, seen, item)
+                    if len(best) < k:
+                        heapq.heappush(best, entry)
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, entry)
+        return [(-distance, item) for distance, _, item in sorted(best, reverse=True)]
+
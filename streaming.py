@@ -0,0 +1,36 @@
+'''Chunked responses for listings too large to build in memory.
+
+`stream_response` writes an iterator of models through StreamingResponse as
+it is consumed. Each item is serialized on its own and the chunks are sent
+as they are produced, so memory stays bounded by one db_utils fetch batch.
+Two formats are supported: "ndjson" writes one JSON document per line, and
+"json" writes the same `{key: [...]}` document as the non-streaming route.
+'''
+from typing import Any, Iterable, Iterator
+
+from fastapi.responses import StreamingResponse
+
+from response_cache import encode
+
+STREAM_FORMATS = ("ndjson", "json")
+STREAM_FORMAT_PATTERN = "^(" + "|".join(STREAM_FORMATS) + ")$"
+
+
+def ndjson_chunks(items: Iterable[Any]) -> Iterator[bytes]:
+    for item in items:
+        yield encode(item) + b"\n"
+
+
+def json_array_chunks(key: str, items: Iterable[Any]) -> Iterator[bytes]:
+    yield b"{" + encode(key) + b":["
+    separator = b""
+    for item in items:
+        yield separator + encode(item)
+        separator = b","
+    yield b"]}"
+
+
+def stream_response(format: str, key: str, items: Iterable[Any]) -> StreamingResponse:
+    if format == "ndjson":
+        return StreamingResponse(ndjson_chunks(items), media_type="application/x-ndjson")
+    return StreamingResponse(json_array_chunks(key, items), media_type="application/json")
@@ -0,0 +1,44 @@
+'''In-memory set of usernames for existence checks without a query.
+
+`/user/checkname` and logins with unknown names only need to know whether
+a name exists. The index loads every name once and is kept current by
+insert_user. Users are never deleted and rowids only grow, so when another
+process may have added users (an `invalidate("user")` from the write
+coordinator) the index only reads the rows past the last rowid it has seen.
+The writer checks for such commits every POLL_INTERVAL (0.5 s), so a name
+registered on another worker can take that long to show up here. Without
+the write coordinator nothing reports those users, and db_utils.user_exists
+confirms every name the index does not hold with a query.
+'''
+import sqlite3
+from typing import Optional, Set
+
+from reloadable import Reloadable
+
+
+class UsernameIndex(Reloadable):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._names: Optional[Set[str]] = None
+        self._last_rowid = 0
+
+    def _load(self, conn: sqlite3.Connection) -> None:
+        '''load every name, or only the ones added since the last refresh'''
+        rows = conn.execute(
+            "SELECT rowid, name FROM user WHERE rowid > :last_rowid ORDER BY rowid",
+            {"last_rowid": self._last_rowid}).fetchall()
+        names = self._names if self._names is not None else set()
+        names.update(name for _, name in rows)
+        if rows:
+            self._last_rowid = rows[-1][0]
+        self._names = names
+
+    def add(self, name: str) -> None:
+        with self._lock:
+            if self._names is not None:
+                self._names.add(name)
+
+    def __contains__(self, name: str) -> bool:
+        names = self._names
+        return names is not None and name in names
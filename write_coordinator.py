@@ -0,0 +1,188 @@
+'''Single writer thread with group commit.
+
+SQLite allows one writer at a time, and each commit costs an fsync. Instead
+of letting every db thread race for the write lock, db_utils hands its
+writes to `writer.submit(job)`, where `job(conn)` runs its statements
+without committing. The writer thread takes every job that is queued,
+opens one BEGIN IMMEDIATE transaction, runs each job inside its own
+SAVEPOINT, and commits once for the whole group. A failing job is rolled
+back to its savepoint and its exception is raised to its caller; the
+other jobs of the group still commit.
+
+Under gunicorn every worker process has its own writer, and the processes
+serialize on the database lock (WAL mode plus busy_timeout). The writer
+connection commits every write of its process, so a change of its
+`PRAGMA data_version` means another process wrote. It then drops this
+process's order and sales caches and marks the username index and popular
+ranking stale, which would otherwise serve that data stale until their TTL
+ran out. The catalog caches are only dropped when the `catalog_version`
+counter of migration 8 moved too, so orders and registrations on other
+workers leave them alone.
+
+Until `start` is called (scripts, benchmarks) jobs run inline on the
+calling thread's pooled connection, in their own BEGIN IMMEDIATE
+transaction.
+
+`submit(job, after_commit)` calls `after_commit(result)` once the job's
+transaction has committed, before `submit` returns. Callbacks run in
+commit order: on the writer thread after each group, or, inline, under a
+lock held from BEGIN to the callback. In-memory state derived from the
+writes (the popular ranking) is updated there, so it never sees a write
+that was rolled back or two writes out of order.
+'''
+import contextvars
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple, TypeVar
+
+from cache import invalidate
+from catalog import CATALOG_TABLES
+from db_pool import ConnectionPool
+
+logger = logging.getLogger("trippy.writer")
+
+ReturnT = TypeVar("ReturnT")
+Job = Callable[[sqlite3.Connection], ReturnT]
+# job, after_commit, caller's context, future of the result
+QueuedJob = Tuple[Job, Optional[Callable], contextvars.Context, Future]
+
+COORDINATOR_ENABLED = os.environ.get("TRIPPY_WRITE_COORDINATOR", "1") != "0"
+MAX_GROUP_SIZE = int(os.environ.get("TRIPPY_WRITE_GROUP_SIZE", 64))
+# how often an idle writer checks for commits made by other processes
+POLL_INTERVAL = 0.5
+# what a commit of another process may have changed, catalog tables aside
+WRITTEN_TABLES = ("order", "sales", "user", "popularity")
+
+
+class WriteCoordinator:
+
+    def __init__(self, pool: ConnectionPool, max_group_size: int = MAX_GROUP_SIZE) -> None:
+        self.pool = pool
+        self.max_group_size = max_group_size
+        self.groups = 0
+        self.jobs = 0
+        self._queue: "queue.Queue[Optional[QueuedJob]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._started = threading.Event()
+        # inline writes: commit and after_commit of one write before the next
+        self._inline_lock = threading.Lock()
+
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        self._started.clear()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self) -> None:
+        '''finish the queued jobs, then stop the writer thread'''
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def submit(
+        self,
+        job: Job,
+        after_commit: Optional[Callable[[ReturnT], None]] = None) -> ReturnT:
+        '''run `job(conn)` in a write transaction and return its result, blocking'''
+        if self._thread is None:
+            with self._inline_lock, self.pool.connection() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                result = job(conn)
+                conn.commit()
+                self._after_commit(after_commit, result)
+                return result
+        future: Future = Future()
+        # run the job in the caller's context so its queries count for its request
+        self._queue.put((job, after_commit, contextvars.copy_context(), future))
+        return future.result()
+
+    def _after_commit(
+        self, after_commit: Optional[Callable[[ReturnT], None]], result: ReturnT) -> None:
+        # the write is committed either way, so a failing callback is only logged
+        if after_commit is None:
+            return
+        try:
+            after_commit(result)
+        except Exception:
+            logger.exception("after_commit callback failed")
+
+    def _run(self) -> None:
+        with self.pool.dedicated() as conn:
+            data_version = self._data_version(conn)
+            catalog_version = self._catalog_version(conn)
+            self._started.set()
+            stopping = False
+            while not stopping:
+                try:
+                    first = self._queue.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    first = None
+                else:
+                    stopping = first is None
+                group = [] if first is None else [first]
+                while len(group) < self.max_group_size and not stopping:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                    else:
+                        group.append(item)
+                # check before writing: our own commits do not change it
+                version = self._data_version(conn)
+                if version != data_version:
+                    data_version = version
+                    tables = WRITTEN_TABLES
+                    version = self._catalog_version(conn)
+                    if version != catalog_version:
+                        catalog_version = version
+                        tables += CATALOG_TABLES
+                    invalidate(*tables)
+                if group:
+                    self._commit_group(conn, group)
+
+    def _data_version(self, conn: sqlite3.Connection) -> int:
+        return conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _catalog_version(self, conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT version FROM catalog_version").fetchone()[0]
+
+    def _commit_group(self, conn: sqlite3.Connection, group: List) -> None:
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for job, after_commit, context, future in group:
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((future, context.run(job, conn), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((future, None, e))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.exception("write group of %d jobs failed", len(group))
+            if conn.in_transaction:
+                conn.rollback()
+            for _, _, _, future in group:
+                future.set_exception(e)
+            return
+        self.groups += 1
+        self.jobs += len(group)
+        for (_, after_commit, context, _), (future, result, error) in zip(group, results):
+            if error is None:
+                context.run(self._after_commit, after_commit, result)
+                future.set_result(result)
+            else:
+                future.set_exception(error)